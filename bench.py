@@ -0,0 +1,582 @@
+"""Бенчмарки бота.
+
+Запуск:
+    python bench.py              # все бенчмарки
+    python bench.py validators   # только выбранные
+
+Нагрузочный прогон (load) настраивается переменными окружения:
+LOAD_USERS, LOAD_EDIT_SHARE, LOAD_SEED. Прогон race (RACE_APPLICATIONS,
+RACE_CLICKS) бьёт параллельными решениями в одни и те же заявки и падает,
+если хоть одна заявка решена дважды. Прогон coldstart COLDSTART_RUNS раз
+запускает бота в новом процессе и меряет время до первого ответа на /start;
+если медиана больше COLDSTART_BUDGET секунд, прогон падает. Прогон cities
+ищет города в индексе из CITY_INDEX_SIZE синтетических названий. Если задан
+BENCH_OUTPUT, итог дописывается туда строкой JSON вместе с хешем коммита —
+так прогоны разных коммитов можно сравнивать.
+"""
+import os
+import sys
+import json
+import queue
+import logging
+import time
+import random
+import timeit
+import asyncio
+import tempfile
+import tracemalloc
+import subprocess
+from collections import Counter, defaultdict
+from logging.handlers import QueueListener
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+# Своя пустая SQLite на каждый запуск и без лимитов Telegram: транспорт фейковый
+os.environ.setdefault('DB_NAME', os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db'))
+os.environ.setdefault('WRITE_BEHIND_PATH', os.path.join(os.path.dirname(os.environ['DB_NAME']), 'intake.db'))
+# Синтетические кандидаты отвечают без пауз — для них антифлуд выключен
+os.environ.setdefault('GUARD_USER_RATE', '1000000')
+os.environ.setdefault('GUARD_USER_BURST', '1000000')
+os.environ.setdefault('GUARD_DUPLICATE_WINDOW', '0')
+os.environ.setdefault('NOTIFY_CHAT_RATE', '1000000')
+os.environ.setdefault('NOTIFY_CHAT_BURST', '1000000')
+os.environ.setdefault('NOTIFY_GLOBAL_RATE', '1000000')
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import main  # noqa: E402
+
+STATE_LABELS = {
+    getattr(main, name): name
+    for name in (
+        'CITIZENSHIP', 'CITIZENSHIP_SNG', 'CITIZENSHIP_OTHER', 'FULL_NAME',
+        'PRIOR_EMPLOYMENT', 'EMPLOYMENT_PERIOD', 'PHONE', 'CITY', 'AGE',
+        'SELF_EMPLOYED', 'SELF_EMPLOYED_CHOICE', 'TRANSPORT', 'CONFIRMATION',
+        'EDIT_FIELD'
+    )
+}
+
+HANDLER_CASES = [
+    (main.CITIZENSHIP, "🇷🇺 РФ"),
+    (main.CITIZENSHIP, "🌍 СНГ/Другое"),
+    (main.CITIZENSHIP_SNG, "🇰🇿 Казахстан"),
+    (main.FULL_NAME, "Иванов Иван Иванович"),
+    (main.PRIOR_EMPLOYMENT, "✅ Да"),
+    (main.EMPLOYMENT_PERIOD, "📅 Меньше 40 дней назад"),
+    (main.PHONE, "+7 (912) 345-67-89"),
+    (main.CITY, "Москва"),
+    (main.CITY, "Казн"),
+    (main.AGE, "25"),
+    (main.SELF_EMPLOYED, "✅ Да"),
+    (main.SELF_EMPLOYED_CHOICE, "🏢 В офисе"),
+    (main.TRANSPORT, "🚲 Вело"),
+    (main.EDIT_FIELD, "Город"),
+]
+
+class StubUser:
+    id = 42
+    username = 'bench'
+
+class StubMessage:
+    def __init__(self, text):
+        self.text = text
+        self.from_user = StubUser()
+
+    async def reply_text(self, text, **kwargs):
+        pass
+
+class StubUpdate:
+    def __init__(self, text):
+        self.message = StubMessage(text)
+        self.effective_user = self.message.from_user
+
+class StubContext:
+    def __init__(self):
+        self.user_data = {}
+
+VALIDATOR_CASES = [
+    (main.CITIZENSHIP, "🇷🇺 РФ"),
+    (main.CITIZENSHIP, "что-то другое"),
+    (main.FULL_NAME, "Иванов Иван Иванович"),
+    (main.FULL_NAME, "ivan"),
+    (main.PHONE, "+7 (912) 345-67-89"),
+    (main.PHONE, "12345"),
+    (main.CITY, "Москва"),
+    (main.CITY, "Масква"),
+    (main.CITY, "абракадабра"),
+    (main.AGE, "25"),
+    (main.AGE, "двадцать"),
+    (main.TRANSPORT, "🚲 Вело"),
+]
+
+def report(rows):
+    width = max(len(name) for name, _ in rows)
+    for name, seconds in rows:
+        print(f"{name:<{width}}  {seconds * 1e6:9.2f} µs/op")
+
+def bench_validators(number=20000):
+    rows = []
+    for state, text in VALIDATOR_CASES:
+        seconds = timeit.timeit(lambda: main.validate(state, text), number=number) / number
+        rows.append((f"{STATE_LABELS[state]} {text!r}", seconds))
+    report(rows)
+
+def bench_handlers(number=20000):
+    # Обработчик целиком, но без сети: reply_text — пустая корутина
+    async def run():
+        rows = []
+        for state, text in HANDLER_CASES:
+            handler = main.flow_engine.handlers[state]
+            update = StubUpdate(text)
+            context = StubContext()
+            started = time.perf_counter()
+            for _ in range(number):
+                await handler(update, context)
+            rows.append((f"{STATE_LABELS[state]} {text!r}", (time.perf_counter() - started) / number))
+        return rows
+
+    report(asyncio.run(run()))
+
+CITY_INDEX_SIZE = int(os.environ.get('CITY_INDEX_SIZE', 40000))
+CITY_SUFFIXES = ("ово", "ево", "овка", "ино", "ское", "ск", "ка", "ный", "овск", "ье")
+CITY_CASES = ["Масква", "Красново", "Сосновка", "Петровское", "Ивановка", "абракадабра"]
+
+def synthetic_cities(count, seed=1):
+    # Как в реальном справочнике населённых пунктов: много общих окончаний
+    rng = random.Random(seed)
+    letters = "абвгдежзиклмнопрстуфхцчшэюя"
+    names = set()
+    while len(names) < count:
+        root = ''.join(rng.choice(letters) for _ in range(rng.randint(3, 7)))
+        names.add((root + rng.choice(CITY_SUFFIXES)).capitalize())
+    return sorted(names)
+
+def bench_cities(number=2000):
+    # Город, которого нет в списке, — худший случай: нечёткий поиск и подсказки
+    index = main.CityIndex([*main.RUSSIAN_CITIES, *synthetic_cities(CITY_INDEX_SIZE)], main.CITY_ALIASES)
+    rows = []
+    for text in CITY_CASES:
+        started = time.perf_counter()
+        for _ in range(number):
+            index.match(text)
+        rows.append((f"match {text!r}", (time.perf_counter() - started) / number))
+    report(rows)
+
+def bench_guard(number=200000):
+    # Пропущенный апдейт и отброшенный флуд должны стоить микросекунды
+    rows = []
+    for name, users in (('новые пользователи', range(number)), ('флуд одного', [1] * number)):
+        guard = main.UpdateGuard(rate=1, burst=5)
+        started = time.perf_counter()
+        for user_id in users:
+            guard.check(user_id, "спам")
+        rows.append((name, (time.perf_counter() - started) / number))
+    report(rows)
+
+def bench_logging(number=20000):
+    # Сколько вызов логгера стоит event loop: JSON в файл напрямую и через очередь
+    sink = tempfile.TemporaryFile('w')
+    direct = logging.StreamHandler(sink)
+    direct.setFormatter(main.JsonFormatter())
+    records = queue.SimpleQueue()
+    queued = main.LogQueueHandler(records)
+    output = logging.StreamHandler(sink)
+    output.setFormatter(main.JsonFormatter())
+    listener = QueueListener(records, output)
+    listener.start()
+
+    main.bind_log_context(update_id=1, user_id=42, state='phone')
+    rows = []
+    for name, handler in (('напрямую', direct), ('через очередь', queued)):
+        handler.addFilter(main.ContextFilter())
+        log = logging.getLogger(f"bench.logging.{len(rows)}")
+        log.propagate = False
+        log.addHandler(handler)
+        started = time.perf_counter()
+        for n in range(number):
+            log.warning("Ошибка БД: %s", n)
+        rows.append((name, (time.perf_counter() - started) / number))
+    listener.stop()
+    sink.close()
+    report(rows)
+
+# ---------- load ----------
+LOAD_USERS = int(os.environ.get('LOAD_USERS', 2000))
+LOAD_EDIT_SHARE = float(os.environ.get('LOAD_EDIT_SHARE', 0.2))  # доля кандидатов, правящих анкету
+LOAD_SEED = int(os.environ.get('LOAD_SEED', 1))
+
+FLOW_SCRIPT = [
+    ('start', "/start"),
+    ('citizenship', "🇷🇺 РФ"),
+    ('full_name', "Иванов Иван Иванович"),
+    ('prior_employment', "✅ Да"),
+    ('employment_period', "📅 Меньше 40 дней назад"),
+    ('phone', "+7 (912) 345-67-89"),
+    ('city', "Масква"),
+    ('age', "25"),
+    ('self_employed', "❌ Нет"),
+    ('self_employed_choice', "📝 Оформить сейчас"),
+    ('transport', "🚲 Вело"),
+]
+EDIT_SCRIPT = [
+    ('confirmation', "✏️ Изменить"),
+    ('edit_field', "Город"),
+    ('city', "Казань"),
+]
+SUBMIT_SCRIPT = [
+    ('confirmation', "✅ Подтвердить"),
+]
+
+class FakeRequest(BaseRequest):
+    """Bot API без сети: отвечает сразу и запоминает кнопки модерации."""
+    def __init__(self, **kwargs):
+        self.calls = 0
+        self.sent = Counter()
+        self.moderation = []
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        self.calls += 1
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif api_method in ('sendMessage', 'editMessageText'):
+            if api_method == 'sendMessage':
+                self.sent[params.get('chat_id')] += 1
+            self.message_id += 1
+            result = {
+                'message_id': self.message_id,
+                'date': 0,
+                'chat': {'id': params.get('chat_id', 1), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+            markup = params.get('reply_markup')
+            if api_method == 'sendMessage' and params.get('chat_id') == main.ADMIN_CHAT_ID \
+                    and isinstance(markup, dict) and 'inline_keyboard' in markup:
+                result['reply_markup'] = markup
+                self.moderation.append(result)
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def message(self, user_id, text):
+        self.update_id += 1
+        message = {
+            'message_id': self.update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Кандидат'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': self.update_id, 'message': message}
+
+    def callback(self, message, data):
+        self.update_id += 1
+        return {
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'from': {'id': main.ADMIN_CHAT_ID, 'is_bot': False, 'first_name': 'Админ'},
+                'chat_instance': 'bench',
+                'data': data,
+                'message': message,
+            }
+        }
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_load_application():
+    # Приложение собирается так же, как в проде, но с фейковым транспортом
+    http_request = main.HTTPXRequest
+    main.HTTPXRequest = FakeRequest
+    try:
+        return main.build_application()
+    finally:
+        main.HTTPXRequest = http_request
+
+async def run_load(users, edit_share, seed):
+    rng = random.Random(seed)
+    factory = UpdateFactory()
+    latencies = defaultdict(list)
+
+    await main.init_db()
+    application = build_load_application()
+    transport = application.bot.request.request
+
+    async def send(label, data):
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies[label].append(time.perf_counter() - started)
+
+    async def candidate(user_id, edits):
+        script = FLOW_SCRIPT + (EDIT_SCRIPT if edits else []) + SUBMIT_SCRIPT
+        for label, text in script:
+            if label == 'phone':
+                text = f"+7 9{user_id:09d}"  # у каждого кандидата свой номер, иначе это дубли
+            await send(label, factory.message(user_id, text))
+            await asyncio.sleep(0)  # даём поработать остальным кандидатам
+
+    async with application:
+        await main.on_startup(application)
+        await application.start()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            candidate(100000 + n, rng.random() < edit_share) for n in range(users)
+        ))
+        flow_seconds = time.perf_counter() - started
+
+        if main.intake.enabled:
+            await main.intake.flush()  # в режиме write-behind админ узнаёт о заявке после записи в БД
+        await main.outbox.relay()  # уведомления админу уходят из outbox фоновым relay
+        while main.notifier.senders:
+            await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            send('moderation', factory.callback(message, button['callback_data']))
+            for message in transport.moderation
+            for button in message['reply_markup']['inline_keyboard'][0][:1]
+        ))
+        moderation_seconds = time.perf_counter() - started
+
+        memory = await measure_conversation_memory(application, factory, users)
+
+        await application.stop()
+        await main.on_shutdown(application)
+    await main.close_stores()
+
+    return {
+        'users': users,
+        'edit_share': edit_share,
+        'seed': seed,
+        'applications': len(transport.moderation),
+        'flow_seconds': flow_seconds,
+        'applications_per_second': len(transport.moderation) / flow_seconds,
+        'moderation_per_second': len(transport.moderation) / moderation_seconds,
+        'bytes_per_conversation': memory,
+        'steps': {
+            label: {
+                'count': len(values),
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+            }
+            for label, values in ((label, sorted(values)) for label, values in latencies.items())
+        },
+    }
+
+async def measure_conversation_memory(application, factory, users):
+    # Половина анкеты: состояние диалога и user_data уже заполнены
+    half = FLOW_SCRIPT[:len(FLOW_SCRIPT) // 2]
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    for n in range(users):
+        for _, text in half:
+            await application.process_update(
+                Update.de_json(factory.message(500000 + n, text), application.bot)
+            )
+    used = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename'))
+    tracemalloc.stop()
+    return used / users
+
+RACE_APPLICATIONS = int(os.environ.get('RACE_APPLICATIONS', 50))
+RACE_CLICKS = int(os.environ.get('RACE_CLICKS', 8))
+
+async def run_race(applications, clicks):
+    factory = UpdateFactory()
+    await main.init_db()
+    application = build_load_application()
+    transport = application.bot.request.request
+    user_data = {
+        'citizenship': "РФ", 'full_name': "Гонка Гонкин", 'phone': "+7 (900) 000-00-00",
+        'city': "Москва", 'age': 30, 'self_employed': "✅ Да", 'transport': "🚗 Авто",
+    }
+
+    async with application:
+        await main.on_startup(application)
+        await application.start()
+
+        saved = [
+            await main.repository.add(user_data, 700000 + n, None, check_duplicates=False)
+            for n in range(applications)
+        ]
+        # Каждую заявку одновременно «нажимают» clicks раз: половина — принять, половина — отклонить
+        clicks_data = []
+        for app in saved:
+            message = {
+                'message_id': app.id, 'date': 0,
+                'chat': {'id': main.ADMIN_CHAT_ID, 'type': 'private'},
+                'text': f"Заявка #{app.id}",
+                'reply_markup': main.InlineKeyboardMarkup([main.moderation_buttons(app.id)]).to_dict(),
+            }
+            for n in range(clicks):
+                action = 'approve' if n % 2 == 0 else 'reject'
+                clicks_data.append(factory.callback(message, f"{action}_{app.id}"))
+        random.Random(LOAD_SEED).shuffle(clicks_data)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            application.process_update(Update.de_json(data, application.bot)) for data in clicks_data
+        ))
+        seconds = time.perf_counter() - started
+        while main.notifier.senders:
+            await asyncio.sleep(0.01)
+
+        def audit(cursor):
+            cursor.execute("SELECT application_id, COUNT(*) FROM status_audit GROUP BY application_id")
+            return dict(cursor.fetchall())
+        audited = await main.repository.run(audit)
+
+        await application.stop()
+        await main.on_shutdown(application)
+    await main.close_stores()
+
+    return {
+        'applications': applications,
+        'clicks': len(clicks_data),
+        'clicks_per_second': len(clicks_data) / seconds,
+        'double_audited': sum(1 for app in saved if audited.get(app.id, 0) != 1),
+        'double_notified': sum(1 for n in range(applications) if transport.sent[700000 + n] != 1),
+    }
+
+def bench_race():
+    result = asyncio.run(run_race(RACE_APPLICATIONS, RACE_CLICKS))
+    print(f"заявок: {result['applications']}, нажатий: {result['clicks']}, "
+          f"{result['clicks_per_second']:.1f} нажатий/с")
+    print(f"решено не ровно один раз: {result['double_audited']}, "
+          f"уведомлено не ровно один раз: {result['double_notified']}")
+    if result['double_audited'] or result['double_notified']:
+        sys.exit("гонка решений: заявка обработана больше одного раза")
+
+COLDSTART_RUNS = int(os.environ.get('COLDSTART_RUNS', 5))
+COLDSTART_BUDGET = float(os.environ.get('COLDSTART_BUDGET', 3.0))
+COLDSTART_USER = 900001
+
+class ColdStartRequest(FakeRequest):
+    """Polling без сети: первый getUpdates приносит /start от кандидата."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.delivered = False
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        if api_method == 'getUpdates':
+            if self.delivered:
+                await asyncio.sleep(0.1)
+                return 200, json.dumps({'ok': True, 'result': []}).encode()
+            self.delivered = True
+            update = UpdateFactory().message(COLDSTART_USER, "/start")
+            return 200, json.dumps({'ok': True, 'result': [update]}).encode()
+        response = await super().do_request(url, method, request_data, **kwargs)
+        if self.sent[COLDSTART_USER]:
+            # TimedRequest отмечает first_reply сразу после возврата отсюда
+            asyncio.get_running_loop().call_soon(self.report)
+        return response
+
+    def report(self):
+        print(json.dumps({'replied_at': time.time(), 'phases': main.startup.phases}), flush=True)
+        os._exit(0)
+
+def coldstart_child():
+    # Один фейковый транспорт и для getUpdates, и для остальных методов
+    request = ColdStartRequest()
+    builder = main.ApplicationBuilder
+    main.HTTPXRequest = lambda **kwargs: request
+    main.ApplicationBuilder = lambda: builder().get_updates_request(request)
+    asyncio.run(main.run_bot())
+
+def bench_coldstart():
+    runs = []
+    for _ in range(COLDSTART_RUNS):
+        # Каждый запуск — новый процесс и новая пустая БД, как после сна инстанса
+        env = dict(os.environ, PORT='0', BOT_MODE='polling', WORKERS='1', WRITE_BEHIND='0',
+                   DB_NAME=os.path.join(tempfile.mkdtemp(prefix='coldstart-'), 'bench.db'))
+        spawned_at = time.time()
+        child = subprocess.run(
+            [sys.executable, __file__, '--coldstart-child'],
+            env=env, capture_output=True, text=True, timeout=60
+        )
+        lines = [line for line in child.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            sys.exit(f"coldstart: бот не ответил (код {child.returncode})\n{child.stderr}")
+        result = json.loads(lines[-1])
+        runs.append({'spawn_to_reply': result['replied_at'] - spawned_at, **result['phases']})
+
+    width = max(len(phase) for run in runs for phase in run)
+    print(f"{'фаза':<{width}}  {'p50 ms':>8}  {'max ms':>8}")
+    summary = {}
+    for phase in runs[0]:
+        values = sorted(run[phase] for run in runs if phase in run)
+        summary[phase] = percentile(values, 0.5)
+        print(f"{phase:<{width}}  {summary[phase] * 1e3:8.1f}  {values[-1] * 1e3:8.1f}")
+
+    output = os.environ.get('BENCH_OUTPUT')
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'commit': git_commit(), 'at': time.time(), 'coldstart': summary}) + "\n")
+    if summary['spawn_to_reply'] > COLDSTART_BUDGET:
+        sys.exit(f"coldstart: первый ответ через {summary['spawn_to_reply']:.2f} с, "
+                 f"бюджет {COLDSTART_BUDGET:.2f} с")
+
+def bench_load():
+    result = asyncio.run(run_load(LOAD_USERS, LOAD_EDIT_SHARE, LOAD_SEED))
+
+    print(f"кандидатов: {result['users']}, заявок: {result['applications']}, "
+          f"{result['applications_per_second']:.1f} заявок/с, "
+          f"модерация: {result['moderation_per_second']:.1f} решений/с")
+    print(f"память на активный диалог: {result['bytes_per_conversation'] / 1024:.1f} KiB")
+    width = max(len(label) for label in result['steps'])
+    print(f"{'шаг':<{width}}  {'n':>6}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+    for label, step in result['steps'].items():
+        print(f"{label:<{width}}  {step['count']:>6}  {step['p50'] * 1e3:8.2f}  "
+              f"{step['p95'] * 1e3:8.2f}  {step['p99'] * 1e3:8.2f}")
+
+    output = os.environ.get('BENCH_OUTPUT')
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'commit': git_commit(), 'at': time.time(), **result}, ensure_ascii=False) + "\n")
+
+BENCHMARKS = {
+    'validators': bench_validators,
+    'handlers': bench_handlers,
+    'guard': bench_guard,
+    'cities': bench_cities,
+    'logging': bench_logging,
+    'load': bench_load,
+    'race': bench_race,
+    'coldstart': bench_coldstart,
+}
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--coldstart-child']:
+        coldstart_child()
+        sys.exit("coldstart: бот остановился, не ответив")
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
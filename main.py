@@ -1,12 +1,33 @@
 import os
 import sqlite3
+import asyncio
+import threading
 import logging
-import signal
 import re
-from threading import Thread
-from datetime import datetime
-from flask import Flask
+import json
+import csv
+import bisect
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import time
+import signal
+import queue
+import random
+import atexit
+import uuid
+import secrets
+import contextvars
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from functools import lru_cache, wraps
+from xml.sax.saxutils import escape as xml_escape
+from dataclasses import dataclass, field
+from telegram import error as telegram_error
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -14,29 +35,84 @@ from telegram import (
     ReplyKeyboardRemove
 )
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
     ConversationHandler,
     CallbackContext,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput
 )
-
-# ========== FLASK INIT ==========
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "🚀 Бот активен! Порт: " + os.environ.get('PORT', '10000'), 200
-
-def run_flask():
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
+from telegram.request import BaseRequest, HTTPXRequest
 
 # ========== CONFIG ==========
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+PORT = int(os.environ.get('PORT', 10000))
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # polling | webhook
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # внешний адрес сервиса, без пути
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# Без заданного секрета берётся случайный на время работы процесса: он же
+# передаётся в set_webhook, так что чужие POST на WEBHOOK_PATH отвергаются
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WORKERS = int(os.environ.get('WORKERS', 1))  # >1 только в режиме webhook
+ADMIN_WORKER = 0
 ADMIN_CHAT_ID = int(os.environ.get('ADMIN_CHAT_ID'))
-DB_NAME = "applications.db"
+DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_NAME = os.environ.get('DB_NAME', "applications.db")
+DB_BACKEND = os.environ.get('DB_BACKEND', 'postgres' if DATABASE_URL else 'sqlite')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))  # секунды
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 5000))  # миллисекунды
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require')
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'db')  # db | sqlite | none
+STATE_DB_NAME = os.environ.get('STATE_DB_NAME', "state.db")
+STATE_FLUSH_INTERVAL = int(os.environ.get('STATE_FLUSH_INTERVAL', 10))  # секунды
+CITIES_FILE = os.environ.get('CITIES_FILE')  # доп. список городов, по одному в строке
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))  # секунды
+SESSION_SWEEP_INTERVAL = int(os.environ.get('SESSION_SWEEP_INTERVAL', 600))  # секунды
+STATS_RECONCILE_INTERVAL = int(os.environ.get('STATS_RECONCILE_INTERVAL', 300))  # секунды
+NOTIFY_CHAT_RATE = float(os.environ.get('NOTIFY_CHAT_RATE', 1))  # сообщений в секунду на чат
+NOTIFY_CHAT_BURST = int(os.environ.get('NOTIFY_CHAT_BURST', 3))
+NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 25))  # сообщений в секунду на бота
+NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', 5))
+ADMIN_DIGEST_SIZE = int(os.environ.get('ADMIN_DIGEST_SIZE', 1))  # 1 — без дайджеста
+ADMIN_DIGEST_WINDOW = float(os.environ.get('ADMIN_DIGEST_WINDOW', 30))  # секунды
+GUARD_USER_RATE = float(os.environ.get('GUARD_USER_RATE', 1))  # апдейтов в секунду на пользователя
+GUARD_USER_BURST = int(os.environ.get('GUARD_USER_BURST', 5))
+GUARD_DUPLICATE_WINDOW = float(os.environ.get('GUARD_DUPLICATE_WINDOW', 2))  # секунды
+GUARD_WARN_INTERVAL = float(os.environ.get('GUARD_WARN_INTERVAL', 30))  # секунды
+GUARD_IDLE_TTL = 60  # секунды; простаивающие bucket'ы забываются
+GUARD_MAX_IN_FLIGHT = int(os.environ.get('GUARD_MAX_IN_FLIGHT', 256))
+GUARD_QUEUE_SIZE = int(os.environ.get('GUARD_QUEUE_SIZE', 1000))
+METRICS_PUSH_INTERVAL = float(os.environ.get('METRICS_PUSH_INTERVAL', 5))  # секунды, воркер -> диспетчер
+EXPORT_PART_SIZE = int(os.environ.get('EXPORT_PART_SIZE', 45 * 1024 * 1024))  # байт; лимит Bot API — 50 МБ
+EXPORT_UPLOAD_TIMEOUT = float(os.environ.get('EXPORT_UPLOAD_TIMEOUT', 300))  # секунды
+EXPORT_BATCH = 1000
+STATS_DAYS = 7
+STATS_RECENT = 5
+QUEUE_PAGE_SIZE = 10
+FIND_PAGE_SIZE = 10
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_PATH = os.environ.get('WRITE_BEHIND_PATH', "intake.db")
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', 200))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 1))  # секунды
+WRITE_BEHIND_ID_BLOCK = int(os.environ.get('WRITE_BEHIND_ID_BLOCK', 100))
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', 50))
+OUTBOX_INTERVAL = float(os.environ.get('OUTBOX_INTERVAL', 1))  # секунды
+OUTBOX_LEASE = int(os.environ.get('OUTBOX_LEASE', 300))  # секунды на доставку пачки
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 20))
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # json | text
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_INFO_SAMPLE_RATE = float(os.environ.get('LOG_INFO_SAMPLE_RATE', 1))  # доля пишущихся INFO и DEBUG
+DEDUP_WINDOW_DAYS = int(os.environ.get('DEDUP_WINDOW_DAYS', 30))
+DEDUP_FILTER_BITS = 1 << 23  # 1 МБ: ~1% ложных срабатываний на 800 тыс. контактов
+DEDUP_FILTER_HASHES = 7
 
 # ========== DIALOG STATES ==========
 (
@@ -56,20 +132,1613 @@ DB_NAME = "applications.db"
     EDIT_FIELD,
 ) = range(14)
 
+STATE_NAMES = {
+    CITIZENSHIP: 'citizenship',
+    CITIZENSHIP_SNG: 'citizenship_sng',
+    CITIZENSHIP_OTHER: 'citizenship_other',
+    FULL_NAME: 'full_name',
+    PRIOR_EMPLOYMENT: 'prior_employment',
+    EMPLOYMENT_PERIOD: 'employment_period',
+    PHONE: 'phone',
+    CITY: 'city',
+    AGE: 'age',
+    SELF_EMPLOYED: 'self_employed',
+    SELF_EMPLOYED_CHOICE: 'self_employed_choice',
+    TRANSPORT: 'transport',
+    CONFIRMATION: 'confirmation',
+    EDIT_FIELD: 'edit_field',
+}
+
 # ========== LOGGING ==========
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Обработчик в event loop только кладёт запись в очередь; форматирование и
+# запись в stderr — в потоке QueueListener. Каждая запись несёт контекст
+# апдейта из contextvars: update_id, user_id и шаг анкеты, а дальше — номер
+# заявки. По app_id запрос прослеживается от сохранения заявки через
+# отправку админу до его решения.
+log_context = contextvars.ContextVar('log_context', default={})
+
+def bind_log_context(**fields):
+    # Контекст дополняется: в задаче апдейта он общий для всех обработчиков
+    log_context.set({**log_context.get(), **fields})
+
+class ContextFilter(logging.Filter):
+    """Снимок контекста в момент вызова логгера и выборка INFO-записей."""
+    def __init__(self, sample_rate=LOG_INFO_SAMPLE_RATE):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        context = log_context.get()
+        if record.levelno <= logging.INFO and self.sample_rate < 1:
+            # Выборка по пользователю: его диалог попадает в лог целиком или никак
+            user_id = context.get('user_id')
+            point = user_id * 2654435761 % 2 ** 32 / 2 ** 32 if user_id is not None else random.random()
+            if point >= self.sample_rate:
+                return False
+        record.context = context
+        return True
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Аргументы подставляются сразу (объекты могут измениться), а
+        # трассировка исключения форматируется уже в потоке записи. Запись
+        # не копируется: getMessage() у неё от этого не меняется
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        context = getattr(record, 'context', {})
+        if context:
+            text += " [" + " ".join(f"{key}={value}" for key, value in context.items()) + "]"
+        return text
+
+def setup_logging():
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    records = queue.SimpleQueue()
+    handler = LogQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    listener = QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)  # дописать очередь при выходе
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# ========== METRICS ==========
+# Метрики в текстовом формате Prometheus, отдаются на /metrics того же порта.
+# Нужны только счётчики, gauge и гистограммы, поэтому реестр свой, без
+# prometheus_client. Снимок реестра — обычные кортежи, так что воркеры
+# пересылают его диспетчеру через multiprocessing.Queue.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = []
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        METRICS.append(self)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '', dict(zip(self.labels, key)), value
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class GaugeMetric(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect  # значения считаются в момент запроса
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return super().samples()
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            # счётчики по корзинам, затем сумма и количество
+            series = self.values[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        for key, series in self.values.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield '_bucket', {**labels, 'le': bound}, cumulative
+            yield '_sum', labels, series[-2]
+            yield '_count', labels, series[-1]
+
+def collect_metrics():
+    return [(metric.name, metric.kind, metric.help, list(metric.samples())) for metric in METRICS]
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+def render_metrics(sources):
+    """sources — пары (доп. метки, снимок collect_metrics())."""
+    families = {}
+    for extra, snapshot in sources:
+        for name, kind, help, samples in snapshot:
+            family = families.setdefault(name, (kind, help, []))
+            family[2].extend((suffix, {**extra, **labels}, value) for suffix, labels, value in samples)
+
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def timed(histogram, *labels):
+    def decorate(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorate
+
+class TimedRequest(BaseRequest):
+    """Обёртка над HTTP-клиентом бота: время каждого вызова Bot API."""
+    def __init__(self, request):
+        self.request = request
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            result = await self.request.do_request(url, method, request_data=request_data, **kwargs)
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, api_method)
+        if api_method == 'sendMessage' and startup.mark('first_reply'):
+            logger.info("Первый ответ после запуска: %s", startup.summary())
+        return result
+
+class Funnel:
+    """На каком шаге сейчас каждый диалог и где кандидаты уходят."""
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.current = {}  # user_id -> (состояние, время входа)
+
+    def enter(self, user_id, state):
+        FUNNEL_ENTERED.inc(STATE_NAMES[state])
+        self.current[user_id] = (state, time.monotonic())
+
+    def finish(self, user_id, outcome):
+        entry = self.current.pop(user_id, None)
+        if outcome == 'submitted':
+            FUNNEL_SUBMITTED.inc()
+        elif entry is not None:
+            FUNNEL_ABANDONED.inc(STATE_NAMES[entry[0]], outcome)
+
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for user_id, (state, entered) in list(self.current.items()):
+            if entered < cutoff:
+                del self.current[user_id]
+                FUNNEL_ABANDONED.inc(STATE_NAMES[state], 'timeout')
+
+    def active(self):
+        self.expire()
+        counts = Counter(STATE_NAMES[state] for state, _ in self.current.values())
+        return {(name,): count for name, count in counts.items()}
+
+def process_uptime():
+    # Секунды с запуска процесса по /proc (Linux), вместе со стартом
+    # интерпретатора; на других системах — None
+    try:
+        with open('/proc/self/stat') as f:
+            started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class StartupTimer:
+    """Фазы холодного старта: секунды от запуска процесса до конца фазы.
+
+    Импорт считается завершённым в момент создания таймера; если время
+    запуска процесса неизвестно, отсчёт идёт от этого момента.
+    """
+    def __init__(self):
+        uptime = process_uptime()
+        self.origin = time.perf_counter() - (uptime or 0.0)
+        self.phases = {}
+        if uptime is not None:
+            self.phases['imports'] = uptime
+
+    def mark(self, phase):
+        # Засчитывается только первое прохождение фазы
+        if phase in self.phases:
+            return False
+        self.phases[phase] = time.perf_counter() - self.origin
+        return True
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds:.3f} с" for phase, seconds in self.phases.items())
+
+    def snapshot(self):
+        return {(phase,): seconds for phase, seconds in self.phases.items()}
+
+async def loop_lag_monitor(interval=1.0):
+    # Насколько позже запланированного просыпается sleep — столько
+    # event loop был занят чужим синхронным кодом
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        EVENT_LOOP_LAG.observe(lag)
+
+funnel = Funnel()
+startup = StartupTimer()
+
+HANDLER_SECONDS = HistogramMetric(
+    'bot_handler_seconds', 'Время обработки апдейта, по обработчикам', ('handler',))
+DB_SECONDS = HistogramMetric(
+    'bot_db_seconds', 'Время запросов к БД, по операциям', ('operation',))
+DB_ERRORS = CounterMetric(
+    'bot_db_errors_total', 'Ошибки запросов к БД, по операциям', ('operation',))
+TELEGRAM_SECONDS = HistogramMetric(
+    'bot_telegram_request_seconds', 'Время вызовов Bot API, по методам', ('method',))
+FUNNEL_ENTERED = CounterMetric(
+    'bot_funnel_entered_total', 'Сколько раз кандидаты доходили до шага', ('state',))
+FUNNEL_ABANDONED = CounterMetric(
+    'bot_funnel_abandoned_total', 'Брошенные анкеты: шаг и причина (cancel, restart, timeout, error)',
+    ('state', 'reason'))
+FUNNEL_SUBMITTED = CounterMetric(
+    'bot_funnel_submitted_total', 'Отправленные анкеты')
+CONVERSATIONS_ACTIVE = GaugeMetric(
+    'bot_conversations_active', 'Незавершённые анкеты, по текущему шагу', ('state',),
+    collect=funnel.active)
+GUARD_DROPPED = CounterMetric(
+    'bot_guard_dropped_total', 'Апдейты, отброшенные до обработки: rate или duplicate', ('reason',))
+EVENT_LOOP_LAG = HistogramMetric(
+    'bot_event_loop_lag_seconds', 'Задержка event loop относительно расписания')
+OUTBOX_EVENTS = CounterMetric(
+    'bot_outbox_total', 'Уведомления из outbox: delivered, retry, dead', ('result',))
+STARTUP_SECONDS = GaugeMetric(
+    'bot_startup_seconds', 'Холодный старт: секунды от запуска процесса до конца фазы', ('phase',),
+    collect=startup.snapshot)
+
 # ========== DATABASE ==========
-def init_db():
+class RepositoryError(Exception):
+    pass
+
+QueuePage = namedtuple('QueuePage', 'rows has_more total city')
+SearchQuery = namedtuple('SearchQuery', 'text phone_digits')
+SavedApplication = namedtuple('SavedApplication', 'id created_at duplicate queued', defaults=(False,))
+# other_user — прошлая заявка с тем же телефоном, но от другого аккаунта;
+# replaced — (город, транспорт) обновлённой заявки до слияния
+Duplicate = namedtuple(
+    'Duplicate', 'merged previous_id previous_status other_user replaced', defaults=(False, None)
+)
+
+def outbox_payload(user_id, username, user_data, previous):
+    # Всё, что нужно для текста уведомления; previous — (id, статус,
+    # другой аккаунт) прошлой заявки
+    return json.dumps({
+        'user_id': user_id,
+        'username': username,
+        'user_data': dict(user_data),
+        'previous': list(previous) if previous else None,
+    }, ensure_ascii=False)
+
+class ApplicationRepository:
+    """Единая точка доступа к таблице applications.
+
+    SQL пишется один раз с плейсхолдерами %s; бэкенд подставляет свой
+    формат параметров и выполняет запросы вне event loop.
+    """
+    placeholder = '%s'
+    dialect = None
+    skip_locked = ""
+    for_update = ""
+    # Задача фоновой миграции при старте: запросы дожидаются схемы
+    migration = None
+
+    def sql(self, query):
+        return query.replace('%s', self.placeholder)
+
+    def _execute(self, func, *args):
+        raise NotImplementedError
+
+    def _execute_streaming(self, func, *args):
+        # Долгое чтение на отдельном соединении, не мешая остальным запросам
+        raise NotImplementedError
+
+    async def run(self, func, *args, streaming=False):
+        if self.migration is not None and not self.migration.done():
+            await asyncio.shield(self.migration)
+        operation = func.__name__.lstrip('_')
+        execute = self._execute_streaming if streaming else self._execute
+        started = time.perf_counter()
+        try:
+            return await execute(func, *args)
+        except RepositoryError:
+            DB_ERRORS.inc(operation)
+            raise
+        except Exception as e:
+            DB_ERRORS.inc(operation)
+            raise RepositoryError(str(e)) from e
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, operation)
+
+    async def close(self):
+        pass
+
+    # --- операции ---
+    APPLICATION_FIELDS = (
+        'full_name', 'citizenship', 'prior_employment', 'employment_period', 'phone',
+        'city', 'age', 'self_employed', 'self_employed_choice', 'transport'
+    )
+
+    def _lock_contact(self, cursor, phone):
+        pass
+
+    def _find_duplicate(self, cursor, user_id, phone, since):
+        # Сначала ещё не разобранная заявка этого же пользователя (её можно
+        # обновить), затем последняя за окно — его или с тем же телефоном
+        cursor.execute(self.sql("""
+            SELECT id, status, user_id FROM applications
+            WHERE (user_id = %s OR phone = %s) AND created_at >= %s
+            ORDER BY CASE WHEN status = 'new' AND user_id = %s THEN 0 ELSE 1 END, created_at DESC, id DESC
+            LIMIT 1
+        """), (user_id, phone, since, user_id))
+        row = cursor.fetchone()
+        return (row[0], row[1], row[2] != user_id) if row else None
+
+    def _insert_application(self, cursor, user_data, user_id, username, check_duplicates, since):
+        values = [user_data.get(name) for name in self.APPLICATION_FIELDS]
+        previous = None
+        if check_duplicates:
+            self._lock_contact(cursor, user_data.get('phone'))
+            previous = self._find_duplicate(cursor, user_id, user_data.get('phone'), since)
+
+        if previous and previous[1] == 'new' and not previous[2]:
+            # Свою неразобранную заявку пользователь обновляет на месте:
+            # место в очереди и сообщение админу остаются прежними. Совпавший
+            # телефон чужой заявки её не трогает — это новая заявка с пометкой.
+            # Строка блокируется до конца транзакции, и статус перечитывается:
+            # решение админа, принятое после поиска, не перезаписывается
+            cursor.execute(self.sql(
+                f"SELECT status, city, transport FROM applications WHERE id = %s{self.for_update}"
+            ), (previous[0],))
+            status, city, transport = cursor.fetchone()
+            if status == 'new':
+                assignments = ", ".join(f"{name} = %s" for name in ('username',) + self.APPLICATION_FIELDS)
+                cursor.execute(self.sql(
+                    f"UPDATE applications SET {assignments} WHERE id = %s RETURNING id, created_at"
+                ), [username] + values + [previous[0]])
+                return SavedApplication(*cursor.fetchone(), Duplicate(True, *previous, (city, transport)))
+            # Решение уже принято — анкета уходит новой заявкой со ссылкой на прежнюю
+            previous = (previous[0], status, previous[2])
+
+        cursor.execute(self.sql(f"""
+            INSERT INTO applications (
+                user_id, username, {', '.join(self.APPLICATION_FIELDS)}, duplicate_of
+            ) VALUES ({', '.join(['%s'] * (len(self.APPLICATION_FIELDS) + 3))})
+            RETURNING id, created_at
+        """), [user_id, username] + values + [previous[0] if previous else None])
+        saved = SavedApplication(*cursor.fetchone(), Duplicate(False, *previous) if previous else None)
+        self._enqueue_announcements(cursor, [(saved.id, user_id, username, user_data, previous)])
+        return saved
+
+    def _enqueue_announcements(self, cursor, entries):
+        # Уведомление админу пишется в outbox в той же транзакции, что и
+        # заявка: либо есть обе строки, либо ни одной
+        now = datetime.now()
+        cursor.executemany(self.sql("""
+            INSERT INTO outbox (application_id, payload, next_attempt_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (application_id) DO NOTHING
+        """), [
+            (app_id, outbox_payload(user_id, username, user_data, previous), now)
+            for app_id, user_id, username, user_data, previous in entries
+        ])
+
+    def _claim_outbox(self, cursor, limit, lease, max_attempts):
+        # Взятая пачка до конца аренды невидима для других: упавший процесс
+        # не теряет уведомления, их доставит следующий заход
+        now = datetime.now()
+        cursor.execute(self.sql(f"""
+            UPDATE outbox SET next_attempt_at = %s, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE next_attempt_at <= %s AND attempts < %s
+                ORDER BY id
+                LIMIT %s{self.skip_locked}
+            )
+            RETURNING id, application_id, payload, attempts
+        """), (now + timedelta(seconds=lease), now, max_attempts, limit))
+        return sorted(cursor.fetchall())
+
+    def _complete_outbox(self, cursor, delivered, retries):
+        if delivered:
+            cursor.execute(self.sql(
+                f"DELETE FROM outbox WHERE id IN ({', '.join(['%s'] * len(delivered))})"
+            ), delivered)
+        cursor.executemany(self.sql("UPDATE outbox SET next_attempt_at = %s WHERE id = %s"), retries)
+
+    def _reserve_ids(self, cursor, count):
+        # Резервировать номера заранее умеет только последовательность Postgres
+        return []
+
+    BATCH_COLUMNS = ('id', 'intake_key', 'user_id', 'username') + APPLICATION_FIELDS + ('created_at', 'duplicate_of')
+
+    def _insert_batch(self, cursor, rows):
+        # Возвращает номера вставленных строк; None — строка уже записана
+        # прошлой попыткой (процесс упал до очистки журнала).
+        # Анкеты, принятые в журнал без проверки дублей (БД была недоступна),
+        # проверяются здесь, по одной, чтобы видеть и предыдущие строки пачки.
+        # Ответ кандидату уже отправлен, поэтому заявка не сливается с
+        # прежней, а получает duplicate_of и пометку для админа. Телефоны
+        # блокируются в одном порядке — без взаимоблокировок воркеров
+        for phone in sorted({row[4].get('phone') or '' for row in rows if row[6]}):
+            self._lock_contact(cursor, phone)
+        query = self.sql(f"""
+            INSERT INTO applications ({', '.join(self.BATCH_COLUMNS)})
+            VALUES ({', '.join(['%s'] * len(self.BATCH_COLUMNS))})
+            ON CONFLICT (intake_key) DO NOTHING
+            RETURNING id
+        """)
+        app_ids, announcements = [], []
+        for app_id, key, user_id, username, user_data, created_at, check in rows:
+            previous = self._find_duplicate(
+                cursor, user_id, user_data.get('phone'), as_datetime(created_at) - timedelta(days=DEDUP_WINDOW_DAYS)
+            ) if check else None
+            values = [user_data.get(name) for name in self.APPLICATION_FIELDS]
+            cursor.execute(query, [app_id, key, user_id, username] + values + [
+                created_at, previous[0] if previous else None
+            ])
+            inserted = cursor.fetchone()
+            app_ids.append(inserted[0] if inserted else None)
+            if inserted:
+                announcements.append((inserted[0], user_id, username, user_data, previous))
+        self._enqueue_announcements(cursor, announcements)
+        return app_ids
+
+    def _search(self, cursor, query, limit, offset):
+        raise NotImplementedError
+
+    def _recent_contacts(self, cursor, since):
+        cursor.execute(self.sql("SELECT user_id, phone FROM applications WHERE created_at >= %s"), (since,))
+        return cursor.fetchall()
+
+    def _stats_snapshot(self, cursor, days, recent):
+        snapshot = {}
+        for column in ('status', 'city', 'transport'):
+            cursor.execute(f"SELECT {column}, COUNT(*) FROM applications GROUP BY {column}")
+            snapshot[column] = cursor.fetchall()
+
+        since = datetime.now() - timedelta(days=days)
+        cursor.execute(self.sql(
+            "SELECT DATE(created_at), COUNT(*) FROM applications WHERE created_at >= %s GROUP BY DATE(created_at)"
+        ), (since,))
+        snapshot['daily'] = cursor.fetchall()
+
+        cursor.execute(self.sql(
+            "SELECT id, created_at, city FROM applications WHERE status = 'new' ORDER BY created_at DESC, id DESC LIMIT %s"
+        ), (recent,))
+        snapshot['recent'] = cursor.fetchall()
+        return snapshot
+
+    def _transition(self, cursor, where, params, new_status, changed_by):
+        # Условие status = 'new' внутри UPDATE: из двух одновременных
+        # решений по заявке проходит только первое
+        cursor.execute(self.sql(f"""
+            UPDATE applications SET status = %s
+            WHERE status = 'new' AND {where}
+            RETURNING id, user_id, full_name
+        """), [new_status, *params])
+        rows = cursor.fetchall()
+        cursor.executemany(self.sql("""
+            INSERT INTO status_audit (application_id, old_status, new_status, changed_by)
+            VALUES (%s, 'new', %s, %s)
+        """), [(row[0], new_status, changed_by) for row in rows])
+        return rows
+
+    def _update_status(self, cursor, app_id, action, changed_by):
+        new_status = 'approved' if action == 'approve' else 'rejected'
+        rows = self._transition(cursor, "id = %s", [app_id], new_status, changed_by)
+        if rows:
+            _, user_id, full_name = rows[0]
+            return True, new_status, user_id, full_name
+
+        # Заявку не перевели: её нет или решение по ней уже принято
+        cursor.execute(self.sql("SELECT status, user_id, full_name FROM applications WHERE id = %s"), (app_id,))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        status, user_id, full_name = result
+        return False, status, user_id, full_name
+
+    def _queue_page(self, cursor, after_id, city, city_ref, limit):
+        # Keyset-пагинация по (status, created_at, id): страница начинается
+        # сразу после последней показанной заявки, без OFFSET. Город можно
+        # задать по заявке-образцу — так он помещается в callback_data.
+        if city_ref:
+            cursor.execute(self.sql("SELECT city FROM applications WHERE id = %s"), (city_ref,))
+            row = cursor.fetchone()
+            city = row[0] if row else None
+
+        conditions, params = ["status = 'new'"], []
+        if city is not None:
+            conditions.append("city = %s")
+            params.append(city)
+        where = " AND ".join(conditions)
+
+        cursor.execute(self.sql(f"SELECT COUNT(*) FROM applications WHERE {where}"), params)
+        total = cursor.fetchone()[0]
+
+        if after_id:
+            where += " AND (created_at, id) > (SELECT created_at, id FROM applications WHERE id = %s)"
+            params.append(after_id)
+        cursor.execute(self.sql(f"""
+            SELECT id, created_at, full_name, city, age, transport
+            FROM applications
+            WHERE {where}
+            ORDER BY created_at, id
+            LIMIT %s
+        """), params + [limit + 1])
+        rows = cursor.fetchall()
+        return QueuePage(rows[:limit], len(rows) > limit, total, city)
+
+    def _bulk_update_status(self, cursor, action, city_ref, app_ids, changed_by):
+        # Одним UPDATE ... RETURNING: либо заявки, показанные на странице,
+        # либо все новые заявки города заявки-образца. Диапазон по ключу
+        # здесь не годится: в него попали бы заявки, которых админ не видел
+        new_status = 'approved' if action == 'approve' else 'rejected'
+        conditions, params = [], []
+        if app_ids:
+            conditions.append(f"id IN ({', '.join(['%s'] * len(app_ids))})")
+            params += app_ids
+        if city_ref:
+            conditions.append("city = (SELECT city FROM applications WHERE id = %s)")
+            params.append(city_ref)
+
+        where = " AND ".join(conditions)
+        return new_status, self._transition(cursor, where, params, new_status, changed_by)
+
+    def _export(self, cursor, filters, sink):
+        conditions, params = [], []
+        if filters.since is not None:
+            conditions.append("created_at >= %s")
+            params.append(filters.since)
+        if filters.until is not None:
+            conditions.append("created_at < %s")
+            params.append(filters.until)
+        if filters.status is not None:
+            conditions.append("status = %s")
+            params.append(filters.status)
+        if filters.city is not None:
+            conditions.append("city = %s")
+            params.append(filters.city)
+
+        query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM applications"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor.execute(self.sql(query + " ORDER BY created_at, id"), params)
+
+        count = 0
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH)
+            if not rows:
+                return count
+            sink.write_rows(rows)
+            count += len(rows)
+
+    def _load_state(self, cursor, kind, since):
+        cursor.execute(self.sql(
+            "SELECT key, data FROM conversation_state WHERE kind = %s AND updated_at >= %s"
+        ), (kind, since))
+        return cursor.fetchall()
+
+    def _save_state(self, cursor, upserts, deletes, expire_before):
+        if upserts:
+            cursor.executemany(self.sql("""
+                INSERT INTO conversation_state (kind, key, data, updated_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (kind, key) DO UPDATE
+                SET data = excluded.data, updated_at = excluded.updated_at
+            """), upserts)
+        if deletes:
+            cursor.executemany(self.sql(
+                "DELETE FROM conversation_state WHERE kind = %s AND key = %s"
+            ), deletes)
+        cursor.execute(self.sql("DELETE FROM conversation_state WHERE updated_at < %s"), (expire_before,))
+
+    def _migrate(self):
+        raise NotImplementedError
+
+    async def migrate(self):
+        try:
+            return await asyncio.to_thread(self._migrate)
+        except Exception as e:
+            raise RepositoryError(str(e)) from e
+
+    async def add(self, user_data, user_id, username, check_duplicates=True, since=None):
+        since = since or datetime.now() - timedelta(days=DEDUP_WINDOW_DAYS)
+        return await self.run(
+            self._insert_application, dict(user_data), user_id, username, check_duplicates, since
+        )
+
+    async def reserve_ids(self, count):
+        return await self.run(self._reserve_ids, count)
+
+    async def insert_batch(self, rows):
+        return await self.run(self._insert_batch, rows)
+
+    async def search(self, query, page=0, limit=FIND_PAGE_SIZE):
+        rows = await self.run(self._search, query, limit + 1, page * limit)
+        return rows[:limit], len(rows) > limit
+
+    async def claim_outbox(self, limit=OUTBOX_BATCH, lease=OUTBOX_LEASE, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        return await self.run(self._claim_outbox, limit, lease, max_attempts)
+
+    async def complete_outbox(self, delivered, retries):
+        await self.run(self._complete_outbox, delivered, retries)
+
+    async def recent_contacts(self, since):
+        return await self.run(self._recent_contacts, since)
+
+    async def stats_snapshot(self, days, recent):
+        return await self.run(self._stats_snapshot, days, recent)
+
+    async def update_status(self, app_id, action, changed_by):
+        return await self.run(self._update_status, app_id, action, changed_by)
+
+    async def queue_page(self, after_id=0, city=None, city_ref=0, limit=QUEUE_PAGE_SIZE):
+        return await self.run(self._queue_page, after_id, city, city_ref, limit)
+
+    async def bulk_update_status(self, action, changed_by, city_ref=0, app_ids=()):
+        # Без обоих фильтров решение ушло бы на все новые заявки
+        if not app_ids and not city_ref:
+            raise ValueError("Не заданы ни заявки, ни город для массового решения")
+        return await self.run(self._bulk_update_status, action, city_ref, list(app_ids), changed_by)
+
+    async def export(self, filters, sink):
+        return await self.run(self._export, filters, sink, streaming=True)
+
+    async def load_state(self, kind, since):
+        return await self.run(self._load_state, kind, since)
+
+    async def save_state(self, upserts, deletes, expire_before):
+        await self.run(self._save_state, upserts, deletes, expire_before)
+
+class PostgresApplicationRepository(ApplicationRepository):
+    dialect = 'postgres'
+    skip_locked = " FOR UPDATE SKIP LOCKED"
+    for_update = " FOR UPDATE"
+    # Пул соединений создаётся один раз и живёт всё время работы процесса.
+    # psycopg2 блокирующий, поэтому запросы выполняются в потоках через
+    # asyncio.to_thread, а семафор не даёт занять больше DB_POOL_MAX соединений
+    # (ThreadedConnectionPool не ждёт свободного соединения, а падает с PoolError).
+
+    def __init__(self, dsn, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.semaphore = asyncio.Semaphore(max_size)
+        self.trigram = None  # установлен ли pg_trgm; проверяется при первом поиске
+
+    def get_pool(self):
+        if self.pool is None:
+            # psycopg2 нужен только этому бэкенду: импорт при первом обращении
+            from psycopg2 import pool as pg_pool
+            self.pool = pg_pool.ThreadedConnectionPool(
+                self.min_size,
+                self.max_size,
+                self.dsn,
+                sslmode=DB_SSLMODE,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+            )
+        return self.pool
+
+    def _run_in_transaction(self, func, *args):
+        pool = self.get_pool()
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                result = func(cursor, *args)
+            conn.commit()
+            return result
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def _migrate(self):
+        # CREATE INDEX CONCURRENTLY не берёт блокировку на запись, но не
+        # работает внутри транзакции, поэтому миграции идут в autocommit.
+        # Advisory lock не даёт нескольким процессам мигрировать одновременно.
+        pool = self.get_pool()
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                try:
+                    cursor.execute(SCHEMA_MIGRATIONS_DDL)
+                    cursor.execute("SELECT version FROM schema_migrations")
+                    applied = {row[0] for row in cursor.fetchall()}
+                    done = []
+                    for version, description, statements in pending_migrations(applied, self.dialect):
+                        for statement in statements:
+                            self._apply(cursor, statement)
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description)
+                        )
+                        done.append(version)
+                    return done
+                finally:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        finally:
+            conn.autocommit = False
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def _apply(self, cursor, statement):
+        if isinstance(statement, Extension):
+            try:
+                cursor.execute(f"CREATE EXTENSION IF NOT EXISTS {statement.name}")
+            except Exception as e:
+                logger.warning("Расширение %s недоступно, миграция без него: %s", statement.name, e)
+                return
+            for dependent in statement.statements:
+                self._apply(cursor, dependent)
+            return
+        try:
+            cursor.execute(render_migration(statement, self.dialect))
+        except Exception:
+            # Упавший CONCURRENTLY оставляет невалидный индекс,
+            # который IF NOT EXISTS потом молча пропустит.
+            if isinstance(statement, Index):
+                cursor.execute(render_migration(DropIndex(statement.name), self.dialect))
+            raise
+
+    def _lock_contact(self, cursor, phone):
+        # Две одновременные анкеты с одним телефоном не должны обе решить,
+        # что дубля нет; блокировка снимается вместе с транзакцией
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (phone or '',))
+
+    def _reserve_ids(self, cursor, count):
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence('applications', 'id')) FROM generate_series(1, %s)",
+            (count,)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def _insert_batch(self, cursor, rows):
+        # Одна многострочная INSERT на пачку; строкам без заранее выданного
+        # номера он резервируется тут же, в той же транзакции
+        missing = sum(1 for row in rows if row[0] is None)
+        fresh = iter(self._reserve_ids(cursor, missing) if missing else ())
+        rows = [(row[0] if row[0] is not None else next(fresh), *row[1:]) for row in rows]
+        if any(row[6] for row in rows):
+            # Есть непроверенные на дубли анкеты (бывает после сбоя БД) —
+            # пачка пишется построчно с проверкой
+            return super()._insert_batch(cursor, rows)
+        records = [
+            (app_id, key, user_id, username,
+             *[user_data.get(name) for name in self.APPLICATION_FIELDS], created_at, None)
+            for app_id, key, user_id, username, user_data, created_at, _ in rows
+        ]
+        from psycopg2.extras import execute_values
+        inserted = set(row[0] for row in execute_values(
+            cursor,
+            f"INSERT INTO applications ({', '.join(self.BATCH_COLUMNS)}) VALUES %s "
+            "ON CONFLICT (intake_key) DO NOTHING RETURNING id",
+            records,
+            page_size=len(records),
+            fetch=True
+        ))
+        self._enqueue_announcements(cursor, [
+            (app_id, user_id, username, user_data, None)
+            for app_id, _, user_id, username, user_data, _, _ in rows
+            if app_id in inserted
+        ])
+        return [record[0] if record[0] in inserted else None for record in records]
+
+    def _enqueue_announcements(self, cursor, entries):
+        if not entries:
+            return
+        from psycopg2.extras import execute_values
+        now = datetime.now()
+        execute_values(cursor, """
+            INSERT INTO outbox (application_id, payload, next_attempt_at) VALUES %s
+            ON CONFLICT (application_id) DO NOTHING
+        """, [
+            (app_id, outbox_payload(user_id, username, user_data, previous), now)
+            for app_id, user_id, username, user_data, previous in entries
+        ], page_size=len(entries))
+
+    def _transition(self, cursor, where, params, new_status, changed_by):
+        # UPDATE и запись в журнал — один оператор с data-modifying CTE,
+        # то есть один запрос к серверу на решение
+        cursor.execute(f"""
+            WITH updated AS (
+                UPDATE applications SET status = %s
+                WHERE status = 'new' AND {where}
+                RETURNING id, user_id, full_name
+            ), audit AS (
+                INSERT INTO status_audit (application_id, old_status, new_status, changed_by)
+                SELECT id, 'new', %s, %s FROM updated
+            )
+            SELECT id, user_id, full_name FROM updated
+        """, [new_status, *params, new_status, changed_by])
+        return cursor.fetchall()
+
+    def _search(self, cursor, query, limit, offset):
+        # С pg_trgm GIN-индексы обслуживают и ILIKE '%...%', и нечёткое
+        # сравнение слов (<%), так что поиск не сканирует таблицу
+        if self.trigram is None:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            self.trigram = cursor.fetchone()[0]
+        if query.phone_digits:
+            cursor.execute(f"""
+                SELECT {SEARCH_COLUMNS} FROM applications
+                WHERE {PG_PHONE_DIGITS} LIKE %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s OFFSET %s
+            """, (f"%{query.phone_digits}%", limit, offset))
+        elif not self.trigram:
+            # Без расширения — только подстрока, полным просмотром таблицы
+            pattern = f"%{query.text}%"
+            cursor.execute(f"""
+                SELECT {SEARCH_COLUMNS} FROM applications
+                WHERE full_name ILIKE %s OR city ILIKE %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s OFFSET %s
+            """, (pattern, pattern, limit, offset))
+        else:
+            pattern = f"%{query.text}%"
+            cursor.execute(f"""
+                SELECT {SEARCH_COLUMNS} FROM applications
+                WHERE full_name ILIKE %s OR city ILIKE %s OR %s <%% full_name
+                ORDER BY word_similarity(%s, full_name) DESC, created_at DESC, id DESC
+                LIMIT %s OFFSET %s
+            """, (pattern, pattern, query.text, query.text, limit, offset))
+        return cursor.fetchall()
+
+    def _run_streaming(self, func, *args):
+        # Именованный курсор — серверный: строки приходят пачками по
+        # EXPORT_BATCH, а не все сразу в память процесса
+        pool = self.get_pool()
+        conn = pool.getconn()
+        try:
+            conn.set_session(readonly=True)
+            with conn.cursor(name=f"stream_{threading.get_ident()}") as cursor:
+                cursor.itersize = EXPORT_BATCH
+                return func(cursor, *args)
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                conn.set_session(readonly=False)
+            pool.putconn(conn, close=bool(conn.closed))
+
+    async def _execute(self, func, *args):
+        async with self.semaphore:
+            return await asyncio.to_thread(self._run_in_transaction, func, *args)
+
+    async def _execute_streaming(self, func, *args):
+        async with self.semaphore:
+            return await asyncio.to_thread(self._run_streaming, func, *args)
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+
+class SQLiteApplicationRepository(ApplicationRepository):
+    # Локальный бэкенд для разработки и тестов. Одно соединение на процесс,
+    # доступ к нему сериализуется блокировкой, запросы идут в потоке.
+    placeholder = '?'
+    dialect = 'sqlite'
+
+    def __init__(self, path=DB_NAME):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+                detect_types=sqlite3.PARSE_DECLTYPES
+            )
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        return self.conn
+
+    def _run_in_transaction(self, func, *args):
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            try:
+                result = func(cursor, *args)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _migrate(self):
+        with self.lock:
+            conn = self.get_connection()
+            conn.execute(SCHEMA_MIGRATIONS_DDL)
+            applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+            done = []
+            for version, description, statements in pending_migrations(applied, self.dialect):
+                try:
+                    for statement in statements:
+                        conn.execute(render_migration(statement, self.dialect))
+                    conn.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (?, ?)",
+                        (version, description)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                done.append(version)
+            return done
+
+    def _search(self, cursor, query, limit, offset):
+        # FTS5 с триграммным токенизатором: поиск подстроки по индексу
+        if query.phone_digits:
+            match = f'phone : "{query.phone_digits}"'
+        else:
+            # Триграммы не ищут подстроки короче трёх символов: такие слова
+            # (инициалы) отбрасываем, а не получаем пустой результат
+            terms = [term for term in query.text.split() if len(term) >= 3] or [query.text]
+            match = " AND ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        cursor.execute(f"""
+            SELECT {SEARCH_COLUMNS} FROM applications
+            WHERE id IN (SELECT rowid FROM applications_fts WHERE applications_fts MATCH ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?
+        """, (match, limit, offset))
+        return cursor.fetchall()
+
+    def _run_streaming(self, func, *args):
+        # В режиме WAL читатель на своём соединении не ждёт писателей,
+        # так что выгрузка не держит общую блокировку
+        with self.lock:
+            self.get_connection()
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            cursor = conn.cursor()
+            return func(cursor, *args)
+        finally:
+            conn.close()
+
+    async def _execute(self, func, *args):
+        return await asyncio.to_thread(self._run_in_transaction, func, *args)
+
+    async def _execute_streaming(self, func, *args):
+        return await asyncio.to_thread(self._run_streaming, func, *args)
+
+    def _close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    async def close(self):
+        # Под блокировкой: запрос, который сейчас идёт в потоке, сначала
+        # завершится, а не потеряет соединение посреди транзакции
+        await asyncio.to_thread(self._close)
+
+def create_repository():
+    if DB_BACKEND == 'postgres':
+        return PostgresApplicationRepository(DATABASE_URL)
+    return SQLiteApplicationRepository(DB_NAME)
+
+def create_state_store():
+    if STATE_BACKEND == 'none':
+        return None
+    if STATE_BACKEND == 'sqlite' and DB_BACKEND != 'sqlite':
+        return SQLiteApplicationRepository(STATE_DB_NAME)
+    return repository
+
+repository = create_repository()
+state_store = create_state_store()
+
+async def close_stores():
+    await repository.close()
+    if state_store is not None and state_store is not repository:
+        await state_store.close()
+
+async def init_db():
+    stores = [repository]
+    if state_store is not None and state_store is not repository:
+        stores.append(state_store)
+    for store in stores:
+        try:
+            applied = await store.migrate()
+            if applied:
+                logger.info("Применены миграции: %s", applied)
+        except RepositoryError as e:
+            logger.error("Ошибка инициализации БД: %s", e)
+
+async def save_application(user_data, user_id, username):
+    phone = user_data.get('phone')
+    maybe_duplicate = contact_filter.might_contain(user_id, phone)
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        if intake.enabled and (not maybe_duplicate or not intake.db_available):
+            # Пока БД недоступна, кандидат не ждёт таймаута соединения:
+            # возможный дубль проверится при записи журнала в БД
+            saved = await intake.append(user_data, user_id, username, check_duplicates=maybe_duplicate)
+        else:
+            try:
+                if intake.enabled:
+                    await intake.flush()  # предыдущая анкета может ещё лежать в журнале
+                saved = await repository.add(user_data, user_id, username, check_duplicates=maybe_duplicate)
+            except RepositoryError as e:
+                if not intake.enabled:
+                    raise
+                intake.db_available = False
+                logger.warning("БД недоступна, заявка в журнал, дубли проверятся при записи: %s", e)
+                saved = await intake.append(user_data, user_id, username, check_duplicates=True)
+    except RepositoryError as e:
+        logger.error("Ошибка БД: %s", e)
+        return None
+
+    bind_log_context(app_id=saved.id)
+    contact_filter.add(user_id, phone)
+    if saved.duplicate and saved.duplicate.merged:
+        stats_cache.record_update(saved.id, saved.duplicate.replaced, user_data.get('city'), user_data.get('transport'))
+    elif not saved.queued:
+        stats_cache.record_new(saved.id, saved.created_at, user_data.get('city'), user_data.get('transport'))
+    return saved
+
+# ========== STATS ==========
+# Счётчики для /stats обновляются инкрементально при вставке и смене статуса,
+# поэтому команда не трогает БД. Раз в STATS_RECONCILE_INTERVAL секунд
+# кэш пересобирается из таблицы, чтобы поправить возможный дрейф
+# (ручные правки в БД, другие процессы).
+def as_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+class ApplicationStats:
+    def __init__(self, days=STATS_DAYS, recent_size=STATS_RECENT):
+        self.days = days
+        self.recent_size = recent_size
+        self.by_status = Counter()
+        self.by_city = Counter()
+        self.by_transport = Counter()
+        self.daily = Counter()
+        self.recent_new = deque(maxlen=recent_size)
+        self.reconciled_at = None
+
+    def record_new(self, app_id, created_at, city, transport):
+        created_at = as_datetime(created_at)
+        self.by_status['new'] += 1
+        self.by_city[city] += 1
+        self.by_transport[transport] += 1
+        self.daily[created_at.date()] += 1
+        self.recent_new.appendleft((app_id, created_at, city))
+
+    def record_status(self, app_id, old_status, new_status):
+        self.by_status[old_status] -= 1
+        self.by_status[new_status] += 1
+        if old_status == 'new':
+            for item in self.recent_new:
+                if item[0] == app_id:
+                    self.recent_new.remove(item)
+                    break
+
+    def record_update(self, app_id, replaced, city, transport):
+        # Слияние повторной анкеты: заявка та же, но город и транспорт могли смениться
+        old_city, old_transport = replaced
+        for counter, old, new in ((self.by_city, old_city, city), (self.by_transport, old_transport, transport)):
+            if old != new:
+                counter[old] -= 1
+                counter[new] += 1
+                if counter[old] <= 0:
+                    del counter[old]
+        for index, item in enumerate(self.recent_new):
+            if item[0] == app_id:
+                self.recent_new[index] = (app_id, item[1], city)
+                break
+
+    def load(self, snapshot):
+        self.by_status = Counter(dict(snapshot['status']))
+        self.by_city = Counter(dict(snapshot['city']))
+        self.by_transport = Counter(dict(snapshot['transport']))
+        self.daily = Counter({
+            as_datetime(str(day)).date(): count for day, count in snapshot['daily']
+        })
+        self.recent_new = deque(
+            ((app_id, as_datetime(created_at), city) for app_id, created_at, city in snapshot['recent']),
+            maxlen=self.recent_size
+        )
+        self.reconciled_at = datetime.now()
+
+    def daily_throughput(self):
+        today = datetime.now().date()
+        return [
+            (day, self.daily.get(day, 0))
+            for day in (today - timedelta(days=offset) for offset in range(self.days))
+        ]
+
+stats_cache = ApplicationStats()
+
+async def reconcile_stats():
+    snapshot = await repository.stats_snapshot(stats_cache.days, stats_cache.recent_size)
+    stats_cache.load(snapshot)
+
+async def stats_reconcile_loop():
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            await reconcile_stats()
+            await reload_contact_filter()
+        except RepositoryError as e:
+            logger.error("Ошибка пересчёта статистики: %s", e)
+
+# ========== DEDUP ==========
+# Повторные анкеты ищутся в БД по user_id и телефону за DEDUP_WINDOW_DAYS.
+# Перед этим — фильтр Блума по уже виденным контактам: если ни user_id,
+# ни телефона в нём нет, человек точно новый и лишний запрос не нужен.
+# Фильтр заполняется из БД при старте и пересобирается вместе со
+# статистикой: так из него уходят контакты старше окна, а в режиме
+# нескольких воркеров подтягиваются телефоны, принятые соседями.
+class ContactFilter:
+    def __init__(self, bits=DEDUP_FILTER_BITS, hashes=DEDUP_FILTER_HASHES, loaded=True):
+        self.bits = bits
+        self.hashes = hashes
+        self.loaded = loaded
+        self.array = bytearray(bits // 8)
+        self.tracking = None  # контакты, добавленные, пока фильтр пересобирается
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def _add(self, value):
+        for position in self._positions(value):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def _contains(self, value):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def add(self, user_id, phone):
+        self._add(f"user:{user_id}")
+        if phone:
+            self._add(f"phone:{phone}")
+        if self.tracking is not None:
+            self.tracking.append((user_id, phone))
+
+    def might_contain(self, user_id, phone):
+        if not self.loaded:
+            return True
+        return self._contains(f"user:{user_id}") or bool(phone) and self._contains(f"phone:{phone}")
+
+# Пока фильтр не загружен, любой контакт считается возможным дублем:
+# проверку делает БД
+contact_filter = ContactFilter(loaded=False)
+
+async def reload_contact_filter():
+    # Новый фильтр не должен потерять контакты, которых ещё нет в выборке:
+    # анкеты из журнала write-behind (журнал читается до запроса к БД,
+    # поэтому записанное между ними попадёт в выборку) и принятые, пока
+    # шёл запрос
+    global contact_filter
+    current = contact_filter
+    current.tracking = added = []
+    try:
+        rebuilt = ContactFilter()
+        for user_id, phone in await intake.contacts():
+            rebuilt.add(user_id, phone)
+        contacts = await repository.recent_contacts(datetime.now() - timedelta(days=DEDUP_WINDOW_DAYS))
+        for user_id, phone in contacts + added:
+            rebuilt.add(user_id, phone)
+        contact_filter = rebuilt
+    finally:
+        current.tracking = None
+
+# ========== WRITE-BEHIND ==========
+# Режим WRITE_BEHIND: подтверждённая анкета сначала ложится в локальный
+# журнал (SQLite, WAL, synchronous=FULL), а в основную БД уходит пачками
+# по WRITE_BEHIND_BATCH строк или раз в WRITE_BEHIND_INTERVAL секунд.
+# Номер заявки берётся из заранее зарезервированного блока значений
+# последовательности, поэтому кандидат получает ответ без обращения к БД,
+# а при недоступной БД приём анкет продолжается. Каждая строка журнала
+# получает ключ intake_key: повтор записи после сбоя не задваивает заявку.
+# Пока БД недоступна, возможные дубли тоже идут в журнал и проверяются при
+# записи пачки. Админ узнаёт о заявке, когда она записана в основную БД:
+# кнопки модерации сразу работают.
+class IntakeBuffer:
+    def __init__(self, store, batch_size=WRITE_BEHIND_BATCH, interval=WRITE_BEHIND_INTERVAL,
+                 id_block=WRITE_BEHIND_ID_BLOCK):
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.id_block = id_block
+        self.reserving = True      # SQLite номера не резервирует — и не пытаемся
+        self.db_available = True   # сбрасывается при ошибке БД, до успешной записи пачки
+        self.conn = None
+        self.lock = threading.Lock()
+        self.ids = deque()
+        self.incoming = []
+        self.writer = None
+        self.pending = 0
+        self.on_flushed = None
+        self.wakeup = None
+        self.flush_lock = None
+        self.task = None
+        self.refill_task = None
+
+    @property
+    def enabled(self):
+        return self.task is not None
+
+    def _open(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS intake (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                app_id INTEGER,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                intake_key TEXT,
+                check_duplicates INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(intake)")}
+        if 'intake_key' not in columns:
+            # Журнал прежней версии: оставшимся строкам ключи выдаются сейчас
+            self.conn.execute("ALTER TABLE intake ADD COLUMN intake_key TEXT")
+            self.conn.execute("ALTER TABLE intake ADD COLUMN check_duplicates INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE intake SET intake_key = lower(hex(randomblob(16)))")
+        self.conn.commit()
+        return self.conn.execute("SELECT COUNT(*) FROM intake").fetchone()[0]
+
+    def _append(self, rows):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO intake (app_id, intake_key, user_id, username, data, created_at, check_duplicates) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+
+    def _read(self, limit):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT seq, app_id, intake_key, user_id, username, data, created_at, check_duplicates "
+                "FROM intake ORDER BY seq LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def _contacts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, data FROM intake").fetchall()
+        return [(user_id, json.loads(data).get('phone')) for user_id, data in rows]
+
+    async def contacts(self):
+        # Контакты анкет, ещё не записанных в основную БД
+        if not self.enabled:
+            return []
+        return await asyncio.to_thread(self._contacts)
+
+    def _delete(self, last_seq):
+        with self.lock:
+            self.conn.execute("DELETE FROM intake WHERE seq <= ?", (last_seq,))
+            self.conn.commit()
+
+    async def start(self, path, on_flushed):
+        self.on_flushed = on_flushed
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.pending = await asyncio.to_thread(self._open, path)
+        if self.pending:
+            logger.info("В журнале %s осталось заявок: %s", path, self.pending)
+        self._refill_ids()
+        self.task = asyncio.create_task(self._flush_loop())
+
+    async def append(self, user_data, user_id, username, check_duplicates=False):
+        app_id = self.ids.popleft() if self.ids else None
+        created_at = datetime.now()
+        row = (
+            app_id, uuid.uuid4().hex, user_id, username,
+            json.dumps(dict(user_data), ensure_ascii=False), created_at, int(check_duplicates)
+        )
+        written = asyncio.get_running_loop().create_future()
+        self.incoming.append((row, written))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._write_incoming())
+        await written
+
+        self.pending += 1
+        if len(self.ids) < self.id_block // 2:
+            self._refill_ids()
+        if self.pending >= self.batch_size:
+            self.wakeup.set()
+        return SavedApplication(app_id, created_at, None, True)
+
+    async def _write_incoming(self):
+        # Групповой коммит: всё, что накопилось, пока шла прошлая запись,
+        # уходит в журнал одной транзакцией и одним fsync
+        while self.incoming:
+            batch, self.incoming = self.incoming, []
+            try:
+                await asyncio.to_thread(self._append, [row for row, _ in batch])
+            except sqlite3.Error as e:
+                error = RepositoryError(f"Журнал заявок: {e}")
+                for _, written in batch:
+                    written.set_exception(error)
+            else:
+                for _, written in batch:
+                    written.set_result(None)
+
+    def _refill_ids(self):
+        if not self.reserving or not self.db_available:
+            return
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.create_task(self._reserve_ids())
+
+    async def _reserve_ids(self):
+        try:
+            ids = await self.store.reserve_ids(self.id_block)
+            self.reserving = bool(ids)
+            self.ids.extend(ids)
+        except RepositoryError as e:
+            # Без запаса номер выдаст БД при записи пачки
+            logger.warning("Не удалось зарезервировать номера заявок: %s", e)
+
+    async def _flush_loop(self):
+        delay = self.interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+                delay = self.interval
+            except RepositoryError as e:
+                self.db_available = False
+                delay = min(delay * 2, 30)
+                logger.warning("Заявок в журнале: %s, запись в БД не удалась, повтор через %s с: %s", self.pending, delay, e)
+
+    async def flush(self):
+        async with self.flush_lock:
+            while True:
+                rows = await asyncio.to_thread(self._read, self.batch_size)
+                if not rows:
+                    return
+                batch = [
+                    (app_id, key, user_id, username, json.loads(data), created_at, bool(check))
+                    for _, app_id, key, user_id, username, data, created_at, check in rows
+                ]
+                # Вставка идемпотентна по intake_key: если процесс упал между
+                # коммитом в БД и очисткой журнала, повтор ничего не задвоит
+                app_ids = await self.store.insert_batch(batch)
+                self.db_available = True
+                await asyncio.to_thread(self._delete, rows[-1][0])
+                self.pending = max(0, self.pending - len(rows))
+                for app_id, (_, _, user_id, username, user_data, created_at, _) in zip(app_ids, batch):
+                    if app_id is not None:
+                        self.on_flushed(app_id, created_at, user_id, username, user_data)
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        try:
+            await self.flush()
+        except RepositoryError as e:
+            logger.warning("Заявок в журнале: %s, они будут записаны при следующем запуске: %s", self.pending, e)
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+intake = IntakeBuffer(repository)
+
+# ========== OUTBOX ==========
+# Уведомление админу о заявке записывается в таблицу outbox в одной
+# транзакции с самой заявкой, а отправляет его фоновый relay: пачками по
+# OUTBOX_BATCH, с арендой строк на время доставки и повторами с растущей
+# паузой. Доставка «хотя бы один раз»: если процесс упал между отправкой
+# и удалением строки, админ получит сообщение повторно — кнопки модерации
+# от этого не сработают дважды.
+class OutboxRelay:
+    def __init__(self, store, batch_size=OUTBOX_BATCH, interval=OUTBOX_INTERVAL,
+                 lease=OUTBOX_LEASE, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.deliver = None
+        self.wakeup = None
+        self.relay_lock = None
+        self.task = None
+        self.stopping = False
+
+    def start(self, deliver):
+        # deliver(app_id, payload) -> True, если сообщение доставлено
+        self.deliver = deliver
+        self.wakeup = asyncio.Event()
+        self.relay_lock = asyncio.Lock()
+        self.task = asyncio.create_task(self._relay_loop())
+
+    def wake(self):
+        # Новая строка в outbox: не ждём следующего опроса
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _relay_loop(self):
+        delay = self.interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            try:
+                await self.relay()
+                delay = self.interval
+            except RepositoryError as e:
+                delay = min(delay * 2, 30)
+                logger.warning("Outbox недоступен, повтор через %s с: %s", delay, e)
+
+    async def relay(self):
+        async with self.relay_lock:
+            while True:
+                rows = await self.store.claim_outbox(self.batch_size, self.lease, self.max_attempts)
+                if not rows:
+                    return
+                results = await asyncio.gather(*(
+                    self.deliver(app_id, json.loads(payload)) for _, app_id, payload, _ in rows
+                ), return_exceptions=True)
+
+                delivered, retries = [], []
+                now = datetime.now()
+                for (outbox_id, app_id, _, attempts), result in zip(rows, results):
+                    if result is True:
+                        delivered.append(outbox_id)
+                        OUTBOX_EVENTS.inc('delivered')
+                    elif attempts >= self.max_attempts:
+                        OUTBOX_EVENTS.inc('dead')
+                        logger.error("Уведомление о заявке #%s не доставлено за %s попыток", app_id, attempts)
+                    else:
+                        OUTBOX_EVENTS.inc('retry')
+                        retries.append((now + timedelta(seconds=min(2 ** attempts, 300)), outbox_id))
+                await self.store.complete_outbox(delivered, retries)
+                if len(rows) < self.batch_size or self.stopping:
+                    return
+
+    async def stop(self, timeout=10):
+        # Дожидаемся текущей пачки; всё остальное останется в outbox до
+        # следующего запуска, а пачка, не успевшая за timeout, — до конца аренды
+        if self.task is None:
+            return
+        self.stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self.task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox не разобран до остановки, уведомления уйдут после перезапуска")
+        self.task = None
+
+outbox = OutboxRelay(repository)
+
+# ========== MIGRATIONS ==========
+# Версии применяются по возрастанию и записываются в schema_migrations.
+# Новые изменения схемы добавляются только в конец списка.
+Index = namedtuple('Index', ['name', 'table', 'columns', 'method', 'unique'], defaults=(None, False))
+DropIndex = namedtuple('DropIndex', ['name'])
+# Необязательная часть миграции Postgres: если расширение не установить
+# (нет пакета или прав, как на многих managed-базах), его операторы
+# пропускаются, а миграция всё равно записывается — следующие не ждут.
+# Чтобы получить их позже: CREATE EXTENSION вручную и удалить версию
+# миграции из schema_migrations.
+Extension = namedtuple('Extension', ['name', 'statements'])
+
+MIGRATION_LOCK_ID = 72190501
+
+SEARCH_COLUMNS = "id, created_at, full_name, phone, city, status"
+PG_PHONE_DIGITS = r"regexp_replace(phone, '\D', '', 'g')"
+SQLITE_PHONE_DIGITS = (
+    "replace(replace(replace(replace(replace({}, ' ', ''), '(', ''), ')', ''), '-', ''), '+', '')"
+)
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+MIGRATIONS = [
+    (1, "applications table", {
+        'postgres': ["""
             CREATE TABLE IF NOT EXISTS applications (
                 id SERIAL PRIMARY KEY,
                 user_id INTEGER NOT NULL,
@@ -87,52 +1756,561 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 status TEXT DEFAULT 'new'
             )
-        """)
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка инициализации БД: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
+        """],
+        'sqlite': ["""
+            CREATE TABLE IF NOT EXISTS applications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                full_name TEXT NOT NULL,
+                citizenship TEXT NOT NULL,
+                prior_employment TEXT,
+                employment_period TEXT,
+                phone TEXT NOT NULL,
+                city TEXT NOT NULL,
+                age INTEGER NOT NULL,
+                self_employed TEXT NOT NULL,
+                self_employed_choice TEXT,
+                transport TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'new'
+            )
+        """],
+    }),
+    (2, "applications indexes", [
+        Index('idx_applications_status_created', 'applications', 'status, created_at DESC'),
+        Index('idx_applications_user_id', 'applications', 'user_id'),
+        Index('idx_applications_city_created', 'applications', 'city, created_at'),
+    ]),
+    (3, "conversation state", [
+        """
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        """,
+        Index('idx_conversation_state_updated', 'conversation_state', 'updated_at'),
+    ]),
+    (4, "moderation queue indexes", [
+        # Ключ keyset-пагинации /queue; обратным проходом обслуживает и
+        # «последние заявки» в /stats, поэтому старый индекс не нужен
+        Index('idx_applications_status_created_id', 'applications', 'status, created_at, id'),
+        Index('idx_applications_status_city_created_id', 'applications', 'status, city, created_at, id'),
+        DropIndex('idx_applications_status_created'),
+    ]),
+    (5, "duplicate detection", {
+        # Миграции Postgres идут в autocommit: если упадёт индекс, колонка
+        # уже будет на месте, и повтор миграции не должен на ней споткнуться.
+        # В SQLite миграция — одна транзакция, а IF NOT EXISTS для колонок нет
+        'postgres': [
+            "ALTER TABLE applications ADD COLUMN IF NOT EXISTS duplicate_of INTEGER",
+            Index('idx_applications_phone_created', 'applications', 'phone, created_at'),
+        ],
+        'sqlite': [
+            "ALTER TABLE applications ADD COLUMN duplicate_of INTEGER",
+            Index('idx_applications_phone_created', 'applications', 'phone, created_at'),
+        ],
+    }),
+    (6, "application search", {
+        # Без pg_trgm поиск работает через ILIKE без индекса
+        'postgres': [
+            Extension('pg_trgm', [
+                Index('idx_applications_full_name_trgm', 'applications', 'full_name gin_trgm_ops', 'gin'),
+                Index('idx_applications_city_trgm', 'applications', 'city gin_trgm_ops', 'gin'),
+                Index('idx_applications_phone_digits_trgm', 'applications',
+                      f"({PG_PHONE_DIGITS}) gin_trgm_ops", 'gin'),
+            ]),
+        ],
+        # Contentless FTS5: телефон индексируется одними цифрами, таблица
+        # поддерживается триггерами
+        'sqlite': [
+            """
+                CREATE VIRTUAL TABLE IF NOT EXISTS applications_fts
+                USING fts5(full_name, phone, city, content='', tokenize='trigram')
+            """,
+            f"""
+                CREATE TRIGGER IF NOT EXISTS applications_fts_insert AFTER INSERT ON applications BEGIN
+                    INSERT INTO applications_fts (rowid, full_name, phone, city)
+                    VALUES (new.id, new.full_name, {SQLITE_PHONE_DIGITS.format('new.phone')}, new.city);
+                END
+            """,
+            f"""
+                CREATE TRIGGER IF NOT EXISTS applications_fts_delete AFTER DELETE ON applications BEGIN
+                    INSERT INTO applications_fts (applications_fts, rowid, full_name, phone, city)
+                    VALUES ('delete', old.id, old.full_name, {SQLITE_PHONE_DIGITS.format('old.phone')}, old.city);
+                END
+            """,
+            f"""
+                CREATE TRIGGER IF NOT EXISTS applications_fts_update
+                AFTER UPDATE OF full_name, phone, city ON applications BEGIN
+                    INSERT INTO applications_fts (applications_fts, rowid, full_name, phone, city)
+                    VALUES ('delete', old.id, old.full_name, {SQLITE_PHONE_DIGITS.format('old.phone')}, old.city);
+                    INSERT INTO applications_fts (rowid, full_name, phone, city)
+                    VALUES (new.id, new.full_name, {SQLITE_PHONE_DIGITS.format('new.phone')}, new.city);
+                END
+            """,
+            f"""
+                INSERT INTO applications_fts (rowid, full_name, phone, city)
+                SELECT id, full_name, {SQLITE_PHONE_DIGITS.format('phone')}, city FROM applications
+            """,
+        ],
+    }),
+    (7, "status audit", {
+        'postgres': ["""
+            CREATE TABLE IF NOT EXISTS status_audit (
+                id SERIAL PRIMARY KEY,
+                application_id INTEGER NOT NULL,
+                old_status TEXT NOT NULL,
+                new_status TEXT NOT NULL,
+                changed_by BIGINT NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """, Index('idx_status_audit_application', 'status_audit', 'application_id')],
+        'sqlite': ["""
+            CREATE TABLE IF NOT EXISTS status_audit (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                application_id INTEGER NOT NULL,
+                old_status TEXT NOT NULL,
+                new_status TEXT NOT NULL,
+                changed_by INTEGER NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """, Index('idx_status_audit_application', 'status_audit', 'application_id')],
+    }),
+    (8, "notification outbox", {
+        'postgres': ["""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id SERIAL PRIMARY KEY,
+                application_id INTEGER NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """, Index('idx_outbox_next_attempt', 'outbox', 'next_attempt_at')],
+        'sqlite': ["""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                application_id INTEGER NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """, Index('idx_outbox_next_attempt', 'outbox', 'next_attempt_at')],
+    }),
+    (9, "write-behind intake keys", {
+        # Ключ строки журнала write-behind: повтор записи пачки после сбоя
+        # не создаёт заявку второй раз
+        'postgres': [
+            "ALTER TABLE applications ADD COLUMN IF NOT EXISTS intake_key TEXT",
+            Index('idx_applications_intake_key', 'applications', 'intake_key', unique=True),
+        ],
+        'sqlite': [
+            "ALTER TABLE applications ADD COLUMN intake_key TEXT",
+            Index('idx_applications_intake_key', 'applications', 'intake_key', unique=True),
+        ],
+    }),
+]
 
-def save_application(user_data, user_id, username):
-    conn = None
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO applications (
-                user_id, username, full_name, citizenship, 
-                prior_employment, employment_period, phone, 
-                city, age, self_employed, self_employed_choice, transport
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            user_id,
-            username,
-            user_data.get('full_name'),
-            user_data.get('citizenship'),
-            user_data.get('prior_employment'),
-            user_data.get('employment_period'),
-            user_data.get('phone'),
-            user_data.get('city'),
-            user_data.get('age'),
-            user_data.get('self_employed'),
-            user_data.get('self_employed_choice'),
-            user_data.get('transport')
-        ))
-        
-        app_id = cursor.fetchone()[0]
-        conn.commit()
-        return app_id
-        
-    except Exception as e:
-        logger.error(f"Ошибка БД: {str(e)}")
+def pending_migrations(applied, dialect):
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        if isinstance(statements, dict):
+            statements = statements[dialect]
+        yield version, description, statements
+
+def render_migration(statement, dialect):
+    # Индексы в Postgres создаются и удаляются CONCURRENTLY, без
+    # блокировки таблицы на запись
+    concurrently = "CONCURRENTLY " if dialect == 'postgres' else ""
+    if isinstance(statement, DropIndex):
+        return f"DROP INDEX {concurrently}IF EXISTS {statement.name}"
+    if not isinstance(statement, Index):
+        return statement
+    using = f"USING {statement.method} " if statement.method else ""
+    unique = "UNIQUE " if statement.unique else ""
+    return f"CREATE {unique}INDEX {concurrently}IF NOT EXISTS {statement.name} ON {statement.table} {using}({statement.columns})"
+
+# ========== CONVERSATION STATE ==========
+# Состояния ConversationHandler и user_data переживают рестарт. PTB сам
+# собирает изменения и раз в STATE_FLUSH_INTERVAL секунд передаёт их сюда;
+# мы копим их и пишем одной транзакцией. Сессии старше SESSION_TTL
+# не загружаются и удаляются из хранилища.
+class ConversationPersistence(BasePersistence):
+    def __init__(self, store, ttl=SESSION_TTL, update_interval=STATE_FLUSH_INTERVAL, owns=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+        self.ttl = ttl
+        # При нескольких воркерах каждый загружает только своих пользователей
+        self.owns = owns or (lambda user_id: True)
+        self.pending = {}
+        self.flush_task = None
+
+    def _cutoff(self):
+        return datetime.now() - timedelta(seconds=self.ttl)
+
+    def _stage(self, kind, key, data):
+        self.pending[(kind, key)] = data
+        # update_* вызываются пачкой через asyncio.gather, поэтому запись
+        # откладывается до конца пачки и уходит одной транзакцией
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def get_user_data(self):
+        rows = await self.store.load_state('user', self._cutoff())
+        return {
+            int(key): json.loads(data)
+            for key, data in rows if self.owns(int(key))
+        }
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
         return None
-    finally:
-        if conn:
-            conn.close()
+
+    async def get_conversations(self, name):
+        rows = await self.store.load_state(f'conversation:{name}', self._cutoff())
+        conversations = {}
+        for key, data in rows:
+            key = tuple(json.loads(key))
+            if self.owns(key[-1]):
+                conversations[key] = json.loads(data)
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(
+            f'conversation:{name}',
+            json.dumps(list(key)),
+            None if new_state is None else json.dumps(new_state)
+        )
+
+    async def update_user_data(self, user_id, data):
+        self._stage('user', str(user_id), json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._stage('user', str(user_id), None)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        running = self.flush_task
+        if running is not None and running is not asyncio.current_task() and not running.done():
+            await running
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        now = datetime.now()
+        upserts = [(kind, key, data, now) for (kind, key), data in pending.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+        try:
+            await self.store.save_state(upserts, deletes, self._cutoff())
+        except RepositoryError as e:
+            logger.error("Ошибка сохранения состояния диалогов: %s", e)
+            # Более свежие изменения, пришедшие во время записи, важнее
+            self.pending = {**pending, **self.pending}
+
+class ConversationExpiry:
+    """Завершает диалоги, в которых кандидат молчит дольше SESSION_TTL.
+
+    conversation_timeout в PTB работает только с JobQueue (APScheduler),
+    поэтому диалоги обходятся периодически: если состояние диалога не
+    менялось дольше ttl, он завершается так же, как по /cancel. Удаление
+    из словаря ConversationHandler попадает и в persistence.
+    """
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.seen = {}  # ключ диалога -> (состояние, когда его увидели)
+
+    def sweep(self, conversations):
+        now = time.monotonic()
+        expired = []
+        for key, state in list(conversations.items()):
+            if not isinstance(state, int):
+                continue  # обработчик ещё выполняется
+            seen = self.seen.get(key)
+            if seen is None or seen[0] != state:
+                self.seen[key] = (state, now)
+            elif now - seen[1] >= self.ttl:
+                del conversations[key]
+                expired.append(key)
+        for key in self.seen.keys() - conversations.keys():
+            del self.seen[key]
+        return expired
+
+# ========== NOTIFICATIONS ==========
+# Исходящие сообщения (админу и кандидатам) идут через очередь, чтобы
+# обработчик отвечал пользователю сразу, а не ждал отправки. Для каждого
+# чата своя очередь и свой token bucket, поверх — общий лимит бота.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class Notifier:
+    def __init__(self, chat_rate=NOTIFY_CHAT_RATE, chat_burst=NOTIFY_CHAT_BURST,
+                 global_rate=NOTIFY_GLOBAL_RATE, max_retries=NOTIFY_MAX_RETRIES,
+                 digest_size=ADMIN_DIGEST_SIZE, digest_window=ADMIN_DIGEST_WINDOW):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.max_retries = max_retries
+        self.queues = {}
+        self.buckets = OrderedDict()  # chat_id -> bucket, по времени последней отправки
+        self.senders = {}
+        self.digest_size = digest_size
+        self.digest_window = digest_window
+        self.digest = []
+        self.digest_timer = None
+
+    def start(self, bot):
+        self.bot = bot
+
+    def send(self, chat_id, text, waiters=(), **kwargs):
+        # waiters — futures, которые узнают, доставлено ли сообщение
+        self.queues.setdefault(chat_id, deque()).append((text, kwargs, waiters))
+        if chat_id not in self.senders:
+            self._prune_buckets()
+            # Отправитель живёт дольше апдейта, создавшего его: контекст логов свой
+            self.senders[chat_id] = asyncio.create_task(self._drain(chat_id), context=contextvars.Context())
+
+    def _prune_buckets(self):
+        # Наполнившееся ведро ничем не отличается от нового, его можно
+        # забыть; в начале — чаты, которым писали раньше всех
+        while self.buckets:
+            chat_id, bucket = next(iter(self.buckets.items()))
+            if not bucket.full():
+                break
+            del self.buckets[chat_id]
+
+    async def _drain(self, chat_id):
+        bind_log_context(chat_id=chat_id)
+        bucket = self.buckets.pop(chat_id, None) or TokenBucket(self.chat_rate, self.chat_burst)
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                text, kwargs, waiters = queue.popleft()
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                message = await self._deliver(chat_id, text, kwargs)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(message is not None)
+        finally:
+            del self.senders[chat_id]
+            self.buckets[chat_id] = bucket
+            if not queue:
+                del self.queues[chat_id]
+
+    async def _deliver(self, chat_id, text, kwargs):
+        for attempt in range(self.max_retries):
+            try:
+                return await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except telegram_error.RetryAfter as e:
+                logger.warning("Flood limit для чата %s, ждём %s с", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (telegram_error.Forbidden, telegram_error.BadRequest) as e:
+                logger.warning("Сообщение в чат %s не доставлено: %s", chat_id, e)
+                return None
+            except telegram_error.NetworkError as e:
+                delay = min(2 ** attempt, 30)
+                logger.warning("Ошибка сети при отправке в чат %s: %s, повтор через %s с", chat_id, e, delay)
+                await asyncio.sleep(delay)
+        logger.error("Сообщение в чат %s не доставлено после %s попыток", chat_id, self.max_retries)
+        return None
+
+    def notify_admin(self, app_id, text):
+        # Возвращает future: True, когда сообщение (или дайджест) доставлено
+        delivered = asyncio.get_running_loop().create_future()
+        if self.digest_size <= 1:
+            self.send(
+                ADMIN_CHAT_ID,
+                text,
+                waiters=(delivered,),
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup([moderation_buttons(app_id)])
+            )
+            return delivered
+
+        self.digest.append((app_id, text, delivered))
+        if len(self.digest) >= self.digest_size:
+            self.flush_digest()
+        elif self.digest_timer is None:
+            self.digest_timer = asyncio.create_task(self._digest_after_window())
+        return delivered
+
+    async def _digest_after_window(self):
+        await asyncio.sleep(self.digest_window)
+        self.digest_timer = None
+        self.flush_digest()
+
+    def flush_digest(self):
+        if self.digest_timer is not None:
+            self.digest_timer.cancel()
+            self.digest_timer = None
+        items, self.digest = self.digest, []
+
+        # Лимит Telegram — 4096 символов на сообщение
+        chunk, length = [], 0
+        for app_id, text, delivered in items:
+            if chunk and length + len(text) > 4000:
+                self._send_digest(chunk)
+                chunk, length = [], 0
+            chunk.append((app_id, text, delivered))
+            length += len(text) + 2
+        if chunk:
+            self._send_digest(chunk)
+
+    def _send_digest(self, items):
+        self.send(
+            ADMIN_CHAT_ID,
+            "\n\n".join(text for _, text, _ in items),
+            waiters=tuple(delivered for _, _, delivered in items),
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([moderation_buttons(app_id, short=True) for app_id, _, _ in items])
+        )
+
+    async def stop(self, timeout=10):
+        self.flush_digest()
+        if self.senders:
+            await asyncio.wait(list(self.senders.values()), timeout=timeout)
+
+def moderation_buttons(app_id, short=False):
+    suffix = f" #{app_id}" if short else ""
+    return [
+        InlineKeyboardButton(f"✅ Принять{suffix}", callback_data=f"approve_{app_id}"),
+        InlineKeyboardButton(f"❌ Отклонить{suffix}", callback_data=f"reject_{app_id}")
+    ]
+
+notifier = Notifier()
+
+# ========== GUARD ==========
+# Дешёвый фильтр перед всеми обработчиками (группа -1): у каждого
+# пользователя свой token bucket, повтор того же текста подряд (двойное
+# нажатие кнопки) схлопывается. Отброшенный апдейт останавливает
+# обработку через ApplicationHandlerStop, так что до регулярок, поиска
+# городов и БД флуд не доходит. Общее число апдейтов в работе ограничено
+# concurrent_updates(GUARD_MAX_IN_FLIGHT), а очередь апдейтов — размером
+# GUARD_QUEUE_SIZE: когда она полна, приём (webhook или polling) ждёт.
+class UpdateGuard:
+    def __init__(self, rate=GUARD_USER_RATE, burst=GUARD_USER_BURST, idle_ttl=GUARD_IDLE_TTL,
+                 duplicate_window=GUARD_DUPLICATE_WINDOW, warn_interval=GUARD_WARN_INTERVAL):
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = idle_ttl
+        self.duplicate_window = duplicate_window
+        self.warn_interval = warn_interval
+        self.users = OrderedDict()  # user_id -> [bucket, последний текст, когда, когда предупреждали]
+
+    def _prune(self, now):
+        # Порядок — по последней активности, так что простаивающие в начале
+        while self.users:
+            user_id, entry = next(iter(self.users.items()))
+            if now - entry[0].updated < self.idle_ttl:
+                break
+            del self.users[user_id]
+
+    def check(self, user_id, text):
+        """Возвращает причину отказа или None, если апдейт пропускается."""
+        now = time.monotonic()
+        self._prune(now)
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = [TokenBucket(self.rate, self.burst), None, 0.0, 0.0]
+        else:
+            self.users.move_to_end(user_id)
+
+        bucket, last_text, last_at, _ = entry
+        if text is not None and text == last_text and now - last_at < self.duplicate_window:
+            return 'duplicate'
+        if not bucket.try_acquire():
+            return 'rate'
+        entry[1], entry[2] = text, now
+        return None
+
+    def should_warn(self, user_id):
+        entry = self.users[user_id]
+        now = time.monotonic()
+        if now - entry[3] < self.warn_interval:
+            return False
+        entry[3] = now
+        return True
+
+update_guard = UpdateGuard()
+
+async def guard_update(update: Update, context: CallbackContext):
+    user = update.effective_user
+    entry = funnel.current.get(user.id) if user else None
+    bind_log_context(
+        update_id=update.update_id,
+        user_id=user.id if user else None,
+        state=STATE_NAMES[entry[0]] if entry else None
+    )
+    if user is None or user.id == ADMIN_CHAT_ID:
+        return
+
+    message = update.effective_message
+    reason = update_guard.check(user.id, message.text if message else None)
+    if reason is None:
+        return
+
+    GUARD_DROPPED.inc(reason)
+    if reason == 'rate' and update.effective_chat and update_guard.should_warn(user.id):
+        notifier.send(update.effective_chat.id, "⏳ Слишком много сообщений. Подождите пару секунд.")
+    raise ApplicationHandlerStop
 
 # ========== VALIDATION ==========
 RUSSIAN_CITIES = {
@@ -181,17 +2359,173 @@ RUSSIAN_CITIES = {
     'элиста', 'энгельс', 'южно-сахалинск', 'юрга', 'якутск', 'ялта', 'ярославль'
 }
 
+CITY_ALIASES = {
+    'спб': 'санкт-петербург',
+    'питер': 'санкт-петербург',
+    'мск': 'москва',
+    'нск': 'новосибирск',
+    'екб': 'екатеринбург'
+}
+
 def normalize_city_name(city: str) -> str:
     return re.sub(r'[^\w\s-]', '', city.lower().strip())
 
+def city_key(city: str) -> str:
+    # Ключ индекса: ё→е, дефисы и лишние пробелы не различаются
+    normalized = normalize_city_name(city).replace('ё', 'е').replace('-', ' ')
+    return ' '.join(normalized.split())
+
+def city_trigrams(key: str):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def format_city_name(name: str) -> str:
+    if name != name.lower():
+        return name
+    return '-'.join(
+        ' '.join(word if word == 'на' else word.capitalize() for word in part.split(' '))
+        for part in name.split('-')
+    )
+
+class CityIndex:
+    """Индекс городов: точный поиск по нормализованному ключу, поиск по
+    префиксу (отсортированный список ключей + bisect) и нечёткий — по
+    триграммам с ранжированием по расстоянию Левенштейна.
+    Строится один раз при старте."""
+
+    # Триграммы общих окончаний («ово», «вка») встречаются в тысячах
+    # названий и почти ничего не говорят о кандидате; их списки
+    # пропускаются, чтобы поиск не зависел от размера справочника
+    max_postings = 500
+
+    def __init__(self, cities=(), aliases=None):
+        self.names = {}
+        self.trigrams = {}
+        self.aliases = {}
+        self.sorted_keys = None
+        for name in cities:
+            self.add(name)
+        for alias, name in (aliases or {}).items():
+            key = city_key(name)
+            if key in self.names:
+                self.aliases[city_key(alias)] = key
+
+    def add(self, name):
+        key = city_key(name)
+        if not key or key in self.names:
+            return
+        self.names[key] = format_city_name(name.strip())
+        self.sorted_keys = None
+        for gram in city_trigrams(key):
+            self.trigrams.setdefault(gram, []).append(key)
+
+    def load_file(self, path):
+        # Одна строка — один населённый пункт; пустые строки и # игнорируются
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    self.add(line)
+
+    def lookup(self, city):
+        key = city_key(city)
+        key = self.aliases.get(key, key)
+        return self.names.get(key)
+
+    def suggest(self, city, limit=5):
+        key = city_key(city)
+        if not key:
+            return []
+        postings = [self.trigrams[gram] for gram in city_trigrams(key) if gram in self.trigrams]
+        if not postings:
+            return []
+        selective = [keys for keys in postings if len(keys) <= self.max_postings]
+        overlap = Counter()
+        for keys in selective or [min(postings, key=len)]:
+            overlap.update(keys)
+
+        max_distance = max(2, len(key) // 3)
+        ranked = []
+        for candidate, shared in overlap.most_common(limit * 4):
+            distance = edit_distance(key, candidate, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -shared, candidate))
+        ranked.sort()
+        return [(self.names[candidate], distance) for distance, _, candidate in ranked[:limit]]
+
+    def prefix(self, city, limit=5):
+        key = city_key(city)
+        if not key:
+            return []
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.names)
+        start = bisect.bisect_left(self.sorted_keys, key)
+        matches = []
+        for candidate in self.sorted_keys[start:start + limit]:
+            if not candidate.startswith(key):
+                break
+            matches.append(self.names[candidate])
+        return matches
+
+    def suggestions(self, city, limit=4, fuzzy=None):
+        # Сначала почти точные совпадения, потом продолжения введённого
+        # префикса, потом остальные нечёткие варианты
+        if fuzzy is None:
+            fuzzy = self.suggest(city, limit)
+        ordered = [name for name, distance in fuzzy if distance <= 1]
+        ordered += self.prefix(city, limit)
+        ordered += [name for name, distance in fuzzy if distance > 1]
+        return list(dict.fromkeys(ordered))[:limit]
+
+    def _unambiguous(self, city, fuzzy):
+        # Опечатку принимаем, только если лучший вариант однозначен
+        if not fuzzy:
+            return None
+        best, distance = fuzzy[0]
+        allowed = 1 if len(city_key(city)) <= 5 else 2
+        if distance > allowed:
+            return None
+        if len(fuzzy) > 1 and fuzzy[1][1] == distance:
+            return None
+        return best
+
+    def resolve(self, city):
+        return self.lookup(city) or self._unambiguous(city, self.suggest(city, limit=2))
+
+    def match(self, city, limit=4):
+        """Город или варианты для клавиатуры — за один нечёткий поиск."""
+        exact = self.lookup(city)
+        if exact:
+            return exact, []
+        fuzzy = self.suggest(city, limit)
+        resolved = self._unambiguous(city, fuzzy)
+        if resolved:
+            return resolved, []
+        return None, self.suggestions(city, limit, fuzzy)
+
+CITY_INDEX = CityIndex(RUSSIAN_CITIES, CITY_ALIASES)
+if CITIES_FILE:
+    CITY_INDEX.load_file(CITIES_FILE)
+
 def is_valid_russian_city(city: str) -> bool:
-    normalized = normalize_city_name(city)
-    aliases = {
-        'спб': 'санкт-петербург',
-        'нск': 'новосибирск',
-        'екб': 'екатеринбург'
-    }
-    return normalized in RUSSIAN_CITIES or aliases.get(normalized) in RUSSIAN_CITIES
+    return CITY_INDEX.resolve(city) is not None
 
 # ========== KEYBOARDS ==========
 SNG_COUNTRIES = [
@@ -214,440 +2548,424 @@ EDIT_FIELD_KEYBOARD = [
     ["Город", "Возраст"],
     ["Транспорт", "Назад"]
 ]
+SKIP_KEYBOARD = [["🚫 Пропустить"]]
 
-# ========== HANDLERS ==========
-async def start(update: Update, context: CallbackContext) -> int:
-    if context.user_data.get('active'):
-        await update.message.reply_text("⚠️ Завершите текущую анкету!")
-        return ConversationHandler.END
-        
-    context.user_data.clear()
-    context.user_data['active'] = True
-    
-    await update.message.reply_text(
-        "🌟 Добро пожаловать в МагнитДоставка! 🌟\n"
-        "Выберите гражданство:",
-        reply_markup=ReplyKeyboardMarkup(
-            CITIZENSHIP_KEYBOARD,
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
+# Разметка клавиатур неизменяема, поэтому каждая собирается один раз при
+# старте вместе с множеством допустимых ответов и переиспользуется всеми
+# обработчиками. Клавиатуру вопроса задаёт его шаг в FLOW; реестр
+# KEYBOARDS (состояние -> клавиатура) собирается из FLOW.
+Keyboard = namedtuple('Keyboard', ['markup', 'choices'])
+
+def build_keyboard(layout, **kwargs):
+    return Keyboard(
+        ReplyKeyboardMarkup(layout, resize_keyboard=True, **kwargs),
+        frozenset(item for row in layout for item in row)
     )
-    return CITIZENSHIP
 
-async def citizenship(update: Update, context: CallbackContext) -> int:
-    choice = update.message.text
-    if choice not in ["🇷🇺 РФ", "🌍 СНГ/Другое"]:
-        await update.message.reply_text("Пожалуйста, выберите вариант из клавиатуры.")
-        return CITIZENSHIP
-    
-    if choice == "🌍 СНГ/Другое":
-        await update.message.reply_text(
-            "🌐 Выберите вашу страну:",
-            reply_markup=ReplyKeyboardMarkup(
-                SNG_COUNTRIES,
-                resize_keyboard=True
-            )
-        )
-        return CITIZENSHIP_SNG
-    
-    context.user_data["citizenship"] = "🇷🇺 Россия"
-    await update.message.reply_text("👤 Введите ФИО полностью:")
-    return FULL_NAME
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+# Убрать клавиатуру прошлого шага; выбора из вариантов нет
+NO_KEYBOARD = Keyboard(REMOVE_KEYBOARD, frozenset())
 
-async def citizenship_sng(update: Update, context: CallbackContext) -> int:
-    country = update.message.text
-    valid_choices = [item for sublist in SNG_COUNTRIES for item in sublist]
-    
-    if country not in valid_choices:
-        await update.message.reply_text("Пожалуйста, выберите вариант из клавиатуры.")
-        return CITIZENSHIP_SNG
-    
-    if country == "🌍 Другая страна":
-        await update.message.reply_text(
-            "🌐 Укажите ваше гражданство:",
-            reply_markup=ReplyKeyboardMarkup(
-                [["🚫 Пропустить"]],
-                resize_keyboard=True
-            )
-        )
-        return CITIZENSHIP_OTHER
-    
-    context.user_data["citizenship"] = country
-    await update.message.reply_text("👤 Введите ФИО полностью:")
-    return FULL_NAME
-
-async def citizenship_other(update: Update, context: CallbackContext) -> int:
-    country = update.message.text.strip()
-    if country == "🚫 Пропустить":
-        country = "Не указано"
-    
-    context.user_data["citizenship"] = f"🌍 {country}"
-    await update.message.reply_text("👤 Введите ФИО полностью:")
-    return FULL_NAME
+NALOG_APP_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📲 Скачать приложение", url="https://npd.nalog.ru/")]
+])
 
-async def full_name(update: Update, context: CallbackContext) -> int:
-    full_name = update.message.text.strip()
-    full_name = ' '.join(full_name.split()).replace('--', '-')
-    
-    pattern = r"""
-        ^
-        [А-ЯЁ]
-        [а-яё-]+
-        (?:\s[А-ЯЁ][а-яё-]+){1,2}
-        $
-    """
-    
-    if not re.fullmatch(pattern, full_name, re.VERBOSE | re.IGNORECASE):
-        examples = "❌ Неверный формат ФИО. Примеры:\n• Иванов Иван\n• Петров-Водкин Алексей"
-        await update.message.reply_text(examples)
-        return FULL_NAME
-    
-    parts = full_name.split()
-    for part in parts:
-        if len(part.replace('-', '')) < 2:
-            await update.message.reply_text("❌ Каждая часть ФИО должна быть минимум из 2 букв")
-            return FULL_NAME
-    
-    context.user_data["full_name"] = full_name.title()
-    
-    await update.message.reply_text(
-        "📋 Ранее работали в МагнитДоставке?",
-        reply_markup=ReplyKeyboardMarkup(
-            PRIOR_EMPLOYMENT_KEYBOARD,
-            resize_keyboard=True
-        )
+@lru_cache(maxsize=1024)
+def suggestion_keyboard(suggestions):
+    return ReplyKeyboardMarkup(
+        [[name] for name in suggestions],
+        one_time_keyboard=True,
+        resize_keyboard=True
     )
-    return PRIOR_EMPLOYMENT
 
-async def prior_employment(update: Update, context: CallbackContext) -> int:
-    answer = update.message.text
-    if answer not in ["✅ Да", "❌ Нет"]:
-        await update.message.reply_text("Пожалуйста, выберите вариант из клавиатуры.")
-        return PRIOR_EMPLOYMENT
-    
-    context.user_data["prior_employment"] = answer
-    
-    if answer == "❌ Нет":
-        await update.message.reply_text("📱 Введите номер телефона (начинается с +7, 7 или 8):")
-        return PHONE
-    
-    await update.message.reply_text(
-        "📆 Укажите срок предыдущей работы:",
-        reply_markup=ReplyKeyboardMarkup(
-            EMPLOYMENT_PERIOD_KEYBOARD,
-            resize_keyboard=True
-        )
-    )
-    return EMPLOYMENT_PERIOD
+# ========== VALIDATORS ==========
+# Правила проверки ответов на шагах анкеты. Регулярные выражения
+# компилируются один раз при импорте; обработчики и сценарий правки
+# полей используют один и тот же реестр VALIDATORS, собранный из FLOW.
+ValidationResult = namedtuple('ValidationResult', ['ok', 'value', 'error', 'suggestions'])
 
-async def employment_period(update: Update, context: CallbackContext) -> int:
-    period = update.message.text
-    valid_choices = ["📅 Меньше 40 дней назад", "🗓️ Больше 40 дней назад"]
-    
-    if period not in valid_choices:
-        await update.message.reply_text("Пожалуйста, выберите вариант из клавиатуры.")
-        return EMPLOYMENT_PERIOD
-    
-    context.user_data["employment_period"] = period
-    
-    if period == "📅 Меньше 40 дней назад":
-        context.user_data["special_note"] = "🚨 ВНИМАНИЕ: Кандидат работал менее 40 дней назад!"
-    
-    await update.message.reply_text("📱 Введите номер телефона (начинается с +7, 7 или 8):")
-    return PHONE
+def accept(value):
+    return ValidationResult(True, value, None, ())
 
-async def phone(update: Update, context: CallbackContext) -> int:
-    raw_phone = update.message.text
-    clean_phone = ''.join(filter(str.isdigit, raw_phone))
-    
-    if clean_phone.startswith('8') and len(clean_phone) == 11:
-        clean_phone = '7' + clean_phone[1:]
-    
-    if not clean_phone.startswith('7') or len(clean_phone) != 11:
-        await update.message.reply_text("❌ Неверный формат номера. Примеры: +79123456789, 79123456789, 89123456789")
-        return PHONE
-    
-    formatted_phone = f"+7 ({clean_phone[1:4]}) {clean_phone[4:7]}-{clean_phone[7:9]}-{clean_phone[9:11]}"
-    context.user_data["phone"] = formatted_phone
-    await update.message.reply_text("🏙️ Введите ваш город:")
-    return CITY
+def reject(error, suggestions=()):
+    return ValidationResult(False, None, error, suggestions)
 
-async def city(update: Update, context: CallbackContext) -> int:
-    city = update.message.text.strip()
-    
-    if len(city) < 2:
-        await update.message.reply_text("❌ Название города слишком короткое")
-        return CITY
-    
-    if any(c.isdigit() or c in '!@#$%^&*()_+={}[]|\\:;"<>,?/~`' for c in city):
-        await update.message.reply_text("❌ Город не должен содержать цифры и спецсимволы")
-        return CITY
-    
-    if not is_valid_russian_city(city):
-        await update.message.reply_text(
-            "❌ Введите корректное название города России\n"
-            "Примеры: Москва, Санкт-Петербург, Казань\n"
-            "Или укажите ближайший крупный город"
-        )
-        return CITY
-    
-    context.user_data["city"] = city.title()
-    await update.message.reply_text("📅 Введите ваш возраст:")
-    return AGE
+FULL_NAME_RE = re.compile(r"[А-ЯЁ][а-яё-]+(?:\s[А-ЯЁ][а-яё-]+){1,2}", re.IGNORECASE)
+NON_DIGITS_RE = re.compile(r"\D")
+CITY_FORBIDDEN_RE = re.compile(r'[\d!@#$%^&*()_+={}\[\]|\\:;"<>,?/~`]')
+AGE_RE = re.compile(r"\d{1,3}")
 
-async def age(update: Update, context: CallbackContext) -> int:
-    try:
-        age = int(update.message.text)
-        if age < 14 or age > 100:
-            raise ValueError
-    except ValueError:
-        await update.message.reply_text("❌ Введите корректный возраст (число от 14 до 100):")
-        return AGE
-    
-    context.user_data["age"] = age
-    
-    if age < 18:
-        context.user_data["age_warning"] = True
-    
-    await update.message.reply_text(
-        "📄 Есть статус самозанятого?",
-        reply_markup=ReplyKeyboardMarkup(
-            STATUS_KEYBOARD,
-            resize_keyboard=True
-        )
-    )
-    return SELF_EMPLOYED
+CHOICE_ERROR = "Пожалуйста, выберите вариант из клавиатуры."
 
-async def self_employed(update: Update, context: CallbackContext) -> int:
-    status = update.message.text
-    if status not in ["✅ Да", "❌ Нет"]:
-        await update.message.reply_text("Пожалуйста, выберите вариант из клавиатуры.")
-        return SELF_EMPLOYED
-    
-    context.user_data["self_employed"] = status
-    
-    if status == "❌ Нет":
-        await update.message.reply_text(
-            "🛠️ Хотите оформить статус сейчас?",
-            reply_markup=ReplyKeyboardMarkup(
-                SELF_EMPLOYED_CHOICE_KEYBOARD,
-                resize_keyboard=True
-            )
-        )
-        return SELF_EMPLOYED_CHOICE
-    
-    await update.message.reply_text(
-        "🚗 Выберите транспорт:",
-        reply_markup=ReplyKeyboardMarkup(
-            TRANSPORT_KEYBOARD,
-            resize_keyboard=True
-        )
+def validate_full_name(text):
+    value = ' '.join(text.split()).replace('--', '-')
+    if not FULL_NAME_RE.fullmatch(value):
+        return reject("❌ Неверный формат ФИО. Примеры:\n• Иванов Иван\n• Петров-Водкин Алексей")
+    if any(len(part.replace('-', '')) < 2 for part in value.split()):
+        return reject("❌ Каждая часть ФИО должна быть минимум из 2 букв")
+    return accept(value.title())
+
+def validate_phone(text):
+    digits = NON_DIGITS_RE.sub('', text)
+    if len(digits) == 11 and digits[0] == '8':
+        digits = '7' + digits[1:]
+    if len(digits) != 11 or digits[0] != '7':
+        return reject("❌ Неверный формат номера. Примеры: +79123456789, 79123456789, 89123456789")
+    return accept(f"+7 ({digits[1:4]}) {digits[4:7]}-{digits[7:9]}-{digits[9:11]}")
+
+def validate_city(text):
+    value = text.strip()
+    if len(value) < 2:
+        return reject("❌ Название города слишком короткое")
+    if CITY_FORBIDDEN_RE.search(value):
+        return reject("❌ Город не должен содержать цифры и спецсимволы")
+    resolved, suggestions = CITY_INDEX.match(value)
+    if resolved:
+        return accept(resolved)
+    if suggestions:
+        return reject("❓ Не нашли такой город. Возможно, вы имели в виду:", tuple(suggestions))
+    return reject(
+        "❌ Введите корректное название города России\n"
+        "Примеры: Москва, Санкт-Петербург, Казань\n"
+        "Или укажите ближайший крупный город"
     )
-    return TRANSPORT
 
-async def self_employed_choice(update: Update, context: CallbackContext) -> int:
-    choice = update.message.text
-    if choice not in ["📝 Оформить сейчас", "🏢 В офисе"]:
-        await update.message.reply_text("Пожалуйста, используйте кнопки ниже👇")
-        return SELF_EMPLOYED_CHOICE
-    
-    context.user_data["self_employed_choice"] = choice
+def validate_age(text):
+    value = text.strip()
+    if not AGE_RE.fullmatch(value) or not 14 <= int(value) <= 100:
+        return reject("❌ Введите корректный возраст (число от 14 до 100):")
+    return accept(int(value))
+
+def validate_text(text):
+    value = text.strip()
+    if not value:
+        return reject("Пожалуйста, введите ответ текстом.")
+    return accept(value)
+
+def choice_validator(choices, error=CHOICE_ERROR):
+    def validate_choice(text):
+        if text in choices:
+            return accept(text)
+        return reject(error)
+    return validate_choice
+
+def validate(state, text):
+    return VALIDATORS[state](text)
+
+# ========== FLOW ==========
+# Анкета описана декларативно: каждый шаг — состояние ConversationHandler,
+# вопрос, клавиатура, проверка ответа, куда сохранить ответ и куда идти
+# дальше. FlowEngine один раз собирает обработчики и таблицы переходов.
+# Новый вопрос — это константа состояния (в DIALOG STATES вместе с именем
+# для метрик) и запись Step; обработчики, KEYBOARDS и VALIDATORS
+# собираются из FLOW сами.
+SUBMIT = 'submit'  # псевдо-состояние: сохранить заявку и завершить диалог
 
-    if choice == "📝 Оформить сейчас":
-        instruction = """
+SELF_EMPLOYED_INSTRUCTION = """
 📋 <b>Простая инструкция:</b>
 
 1. <b>Скачайте приложение</b> 📲
    → <a href="https://npd.nalog.ru/">«Мой налог» от ФНС</a>
 
-2. <b>Заполните данные:</b>
-   • Паспорт РФ
-   • СНИЛС/ИНН
-   • Номер телефона
+2. <b>Заполните данные:</b>
+   • Паспорт РФ
+   • СНИЛС/ИНН
+   • Номер телефона
+
+3. <b>Загрузите фото:</b>
+   📷 Главная страница паспорта
+   📷 Страница с пропиской
+
+4. <b>Отправьте на проверку</b> ✅
+
+5. <b>Получите свидетельство</b> через 1-3 дня 🎉
+"""
+
+SUMMARY_PROMPT = (
+    "📋 <b>Проверьте данные:</b>\n\n"
+    "▫️ ФИО: {full_name}\n"
+    "▫️ Телефон: {phone}\n"
+    "▫️ Город: {city}\n"
+    "▫️ Возраст: {age}\n"
+    "▫️ Транспорт: {transport}\n\n"
+    "<b>Всё верно?</b>"
+)
+
+@dataclass(frozen=True)
+class Step:
+    state: int
+    prompt: str
+    key: str = None                 # поле user_data для ответа
+    next: object = None             # следующее состояние по умолчанию
+    branches: dict = field(default_factory=dict)  # ответ -> состояние
+    values: dict = field(default_factory=dict)    # ответ -> сохраняемое значение, None — не сохранять
+    template: str = None            # формат сохраняемого значения
+    extras: dict = field(default_factory=dict)    # ответ -> доп. поля user_data
+    messages: dict = field(default_factory=dict)  # ответ -> [(текст, kwargs)] перед следующим вопросом
+    keyboard: Keyboard = None       # клавиатура вопроса
+    validator: object = None        # проверка ответа; по умолчанию — выбор из клавиатуры
+    error: str = CHOICE_ERROR       # ответ не из клавиатуры
+    parse_mode: str = None
+    dynamic: bool = False           # вопрос подставляет значения из user_data
+    edits: bool = False             # шаг выбора поля для правки
+
+FLOW = [
+    Step(CITIZENSHIP, "🌟 Добро пожаловать в МагнитДоставка! 🌟\nВыберите гражданство:",
+         key="citizenship", next=FULL_NAME,
+         keyboard=build_keyboard(CITIZENSHIP_KEYBOARD, one_time_keyboard=True),
+         branches={"🌍 СНГ/Другое": CITIZENSHIP_SNG},
+         values={"🇷🇺 РФ": "🇷🇺 Россия", "🌍 СНГ/Другое": None}),
+    Step(CITIZENSHIP_SNG, "🌐 Выберите вашу страну:",
+         key="citizenship", next=FULL_NAME, keyboard=build_keyboard(SNG_COUNTRIES),
+         branches={"🌍 Другая страна": CITIZENSHIP_OTHER},
+         values={"🌍 Другая страна": None}),
+    Step(CITIZENSHIP_OTHER, "🌐 Укажите ваше гражданство:",
+         key="citizenship", next=FULL_NAME,
+         keyboard=build_keyboard(SKIP_KEYBOARD), validator=validate_text,
+         values={"🚫 Пропустить": "Не указано"}, template="🌍 {}"),
+    Step(FULL_NAME, "👤 Введите ФИО полностью:",
+         key="full_name", next=PRIOR_EMPLOYMENT, validator=validate_full_name),
+    Step(PRIOR_EMPLOYMENT, "📋 Ранее работали в МагнитДоставке?",
+         key="prior_employment", next=EMPLOYMENT_PERIOD,
+         keyboard=build_keyboard(PRIOR_EMPLOYMENT_KEYBOARD),
+         branches={"❌ Нет": PHONE}),
+    Step(EMPLOYMENT_PERIOD, "📆 Укажите срок предыдущей работы:",
+         key="employment_period", next=PHONE,
+         keyboard=build_keyboard(EMPLOYMENT_PERIOD_KEYBOARD),
+         extras={"📅 Меньше 40 дней назад": {
+             "special_note": "🚨 ВНИМАНИЕ: Кандидат работал менее 40 дней назад!"
+         }}),
+    Step(PHONE, "📱 Введите номер телефона (начинается с +7, 7 или 8):",
+         key="phone", next=CITY, validator=validate_phone),
+    Step(CITY, "🏙️ Введите ваш город:",
+         key="city", next=AGE, validator=validate_city),
+    Step(AGE, "📅 Введите ваш возраст:",
+         key="age", next=SELF_EMPLOYED, keyboard=NO_KEYBOARD, validator=validate_age),
+    Step(SELF_EMPLOYED, "📄 Есть статус самозанятого?",
+         key="self_employed", next=TRANSPORT, keyboard=build_keyboard(STATUS_KEYBOARD),
+         branches={"❌ Нет": SELF_EMPLOYED_CHOICE}),
+    Step(SELF_EMPLOYED_CHOICE, "🛠️ Хотите оформить статус сейчас?",
+         key="self_employed_choice", next=TRANSPORT,
+         keyboard=build_keyboard(SELF_EMPLOYED_CHOICE_KEYBOARD),
+         error="Пожалуйста, используйте кнопки ниже👇",
+         messages={"📝 Оформить сейчас": [(SELF_EMPLOYED_INSTRUCTION, {
+             'parse_mode': "HTML",
+             'disable_web_page_preview': True,
+             'reply_markup': NALOG_APP_KEYBOARD
+         })]}),
+    Step(TRANSPORT, "🚗 Выберите транспорт:",
+         key="transport", next=CONFIRMATION, keyboard=build_keyboard(TRANSPORT_KEYBOARD),
+         error="Пожалуйста, выберите транспорт из предложенных👇"),
+    Step(CONFIRMATION, SUMMARY_PROMPT,
+         branches={"✅ Подтвердить": SUBMIT, "✏️ Изменить": EDIT_FIELD},
+         keyboard=build_keyboard(CONFIRM_KEYBOARD), error="Используйте кнопки ниже👇",
+         parse_mode="HTML", dynamic=True),
+    Step(EDIT_FIELD, "Выберите поле для изменения:",
+         keyboard=build_keyboard(EDIT_FIELD_KEYBOARD), error="Пожалуйста, выберите поле из списка",
+         branches={
+             "ФИО": FULL_NAME,
+             "Телефон": PHONE,
+             "Город": CITY,
+             "Возраст": AGE,
+             "Транспорт": TRANSPORT,
+             "Назад": CONFIRMATION
+         },
+         edits=True),
+]
+
+# Клавиатуры с вариантами ответа и проверки ответов по состояниям
+KEYBOARDS = {step.state: step.keyboard for step in FLOW if step.keyboard and step.keyboard.choices}
+VALIDATORS = {
+    step.state: step.validator or choice_validator(step.keyboard.choices, step.error)
+    for step in FLOW
+}
+
+class FlowEngine:
+    def __init__(self, steps, submit):
+        self.steps = {step.state: step for step in steps}
+        self.submit = submit
+        self.handlers = {state: self._make_handler(step) for state, step in self.steps.items()}
+
+    def _make_handler(self, step):
+        @timed(HANDLER_SECONDS, STATE_NAMES[step.state])
+        async def handle(update: Update, context: CallbackContext):
+            return await self.handle(step, update, context)
+        handle.__name__ = STATE_NAMES[step.state]
+        return handle
+
+    def conversation_states(self):
+        text_filter = filters.TEXT & ~filters.COMMAND
+        return {
+            state: [MessageHandler(text_filter, handler)]
+            for state, handler in self.handlers.items()
+        }
+
+    async def enter(self, state, update: Update, context: CallbackContext, prompt=None):
+        if state == SUBMIT:
+            return await self.submit(update, context)
+
+        step = self.steps[state]
+        funnel.enter(update.effective_user.id, state)
+        if prompt is None:
+            prompt = step.prompt
+            if step.dynamic:
+                prompt = prompt.format_map(defaultdict(str, context.user_data))
+        markup = step.keyboard.markup if step.keyboard else None
+        await update.message.reply_text(prompt, parse_mode=step.parse_mode, reply_markup=markup)
+        return state
+
+    async def handle(self, step, update: Update, context: CallbackContext):
+        result = validate(step.state, update.message.text)
+        if not result.ok:
+            markup = suggestion_keyboard(result.suggestions) if result.suggestions else None
+            await update.message.reply_text(result.error, reply_markup=markup)
+            return step.state
+
+        answer = result.value
+        if step.key:
+            value = step.values.get(answer, answer)
+            if value is not None:
+                if step.template:
+                    value = step.template.format(value)
+                context.user_data[step.key] = value
+        context.user_data.update(step.extras.get(answer, {}))
+        for text, kwargs in step.messages.get(answer, ()):
+            await update.message.reply_text(text, **kwargs)
+
+        next_state = step.branches.get(answer, step.next)
+
+        if step.edits:
+            if next_state == CONFIRMATION:
+                return await self.enter(CONFIRMATION, update, context)
+            context.user_data["editing_field"] = answer
+            prompt = None
+            if next_state not in KEYBOARDS:
+                prompt = f"Введите новое значение для поля '{answer}':"
+            return await self.enter(next_state, update, context, prompt=prompt)
+
+        if context.user_data.pop("editing_field", None):
+            return await self.enter(CONFIRMATION, update, context)
+        return await self.enter(next_state, update, context)
+
+# ========== HANDLERS ==========
+@timed(HANDLER_SECONDS, 'start')
+async def start(update: Update, context: CallbackContext) -> int:
+    # ConversationHandler вызывает start только когда у пользователя нет
+    # активного диалога, так что оставшийся флаг active всегда устаревший
+    if context.user_data.get('active'):
+        logger.info("Сброс незавершённой анкеты")
+        funnel.finish(update.effective_user.id, 'restart')
+        
+    context.user_data.clear()
+    context.user_data['active'] = True
+    return await flow_engine.enter(CITIZENSHIP, update, context)
+
+def announcement_text(app_id, user_id, username, user_data, duplicate=None):
+    message = [
+        f"🔔 <b>Новая заявка #{app_id}</b>\n\n",
+        f"👤 Пользователь: @{username or 'не указан'} (ID: {user_id})\n",
+        f"▫️ ФИО: {user_data['full_name']}\n",
+        f"▫️ Телефон: {user_data['phone']}\n",
+        f"▫️ Город: {user_data['city']}\n",
+        f"▫️ Возраст: {user_data['age']}\n",
+        f"▫️ Транспорт: {user_data['transport']}\n"
+    ]
 
-3. <b>Загрузите фото:</b>
-   📷 Главная страница паспорта
-   📷 Страница с пропиской
+    if user_data.get('age', 0) < 18:
+        message.append("\n🚨 <b>ВНИМАНИЕ: Несовершеннолетний кандидат!</b>")
 
-4. <b>Отправьте на проверку</b> ✅
+    if 'special_note' in user_data:
+        message.append(f"\n{user_data['special_note']}")
 
-5. <b>Получите свидетельство</b> через 1-3 дня 🎉
-"""
-        await update.message.reply_text(
-            instruction,
-            parse_mode="HTML",
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📲 Скачать приложение", url="https://npd.nalog.ru/")]
-            ])
-        )
-    
-    await update.message.reply_text(
-        "🚗 Выберите транспорт:",
-        reply_markup=ReplyKeyboardMarkup(
-            TRANSPORT_KEYBOARD,
-            resize_keyboard=True
+    if duplicate and duplicate.other_user:
+        message.append(
+            f"\n⚠️ Этот телефон уже был в заявке #{duplicate.previous_id} "
+            f"({duplicate.previous_status}) от другого аккаунта"
         )
+    elif duplicate:
+        message.append(f"\n♻️ Повторная заявка: ранее #{duplicate.previous_id} ({duplicate.previous_status})")
+
+    return "".join(message)
+
+async def deliver_announcement(app_id, payload):
+    # Вызывается relay'ем outbox для каждой строки
+    bind_log_context(app_id=app_id, user_id=payload['user_id'])
+    previous = payload['previous']
+    text = announcement_text(
+        app_id, payload['user_id'], payload['username'], payload['user_data'],
+        Duplicate(False, *previous) if previous else None
     )
-    return TRANSPORT
+    return await notifier.notify_admin(app_id, text)
 
-async def transport(update: Update, context: CallbackContext) -> int:
-    transport = update.message.text
-    if transport not in ["🚗 Авто", "🚲 Вело", "⚡ Электровело"]:
-        await update.message.reply_text("Пожалуйста, выберите транспорт из предложенных👇")
-        return TRANSPORT
-    
-    context.user_data["transport"] = transport
-
-    summary = [
-        "📋 <b>Проверьте данные:</b>\n",
-        f"▫️ ФИО: {context.user_data.get('full_name')}",
-        f"▫️ Телефон: {context.user_data.get('phone')}",
-        f"▫️ Город: {context.user_data.get('city')}",
-        f"▫️ Возраст: {context.user_data.get('age')}",
-        f"▫️ Транспорт: {transport}\n",
-        "<b>Всё верно?</b>"
+def on_intake_flushed(app_id, created_at, user_id, username, user_data):
+    stats_cache.record_new(app_id, created_at, user_data.get('city'), user_data.get('transport'))
+    outbox.wake()
+
+async def submit_application(update: Update, context: CallbackContext) -> int:
+    required_fields = [
+        'citizenship', 'full_name', 'phone',
+        'city', 'age', 'self_employed', 'transport'
     ]
     
-    await update.message.reply_text(
-        "\n".join(summary),
-        parse_mode="HTML",
-        reply_markup=ReplyKeyboardMarkup(
-            CONFIRM_KEYBOARD,
-            resize_keyboard=True
+    missing = [field for field in required_fields if field not in context.user_data]
+    if missing:
+        await update.message.reply_text(
+            f"❌ Ошибка: Отсутствуют данные ({', '.join(missing)})"
         )
-    )
-    return CONFIRMATION
+        context.user_data.clear()
+        funnel.finish(update.effective_user.id, 'error')
+        return ConversationHandler.END
 
-async def confirmation(update: Update, context: CallbackContext) -> int:
-    choice = update.message.text
-    
-    if choice == "✅ Подтвердить":
-        required_fields = [
-            'citizenship', 'full_name', 'phone',
-            'city', 'age', 'self_employed', 'transport'
-        ]
+    try:
+        user = update.message.from_user
+        saved = await save_application(
+            user_data=context.user_data,
+            user_id=user.id,
+            username=user.username
+        )
         
-        missing = [field for field in required_fields if field not in context.user_data]
-        if missing:
+        if not saved:
+            raise ValueError("Ошибка сохранения в БД")
+        funnel.finish(user.id, 'submitted')
+
+        if saved.duplicate and saved.duplicate.merged:
+            # Заявка ещё не разобрана: данные обновлены, админу второй раз не пишем
             await update.message.reply_text(
-                f"❌ Ошибка: Отсутствуют данные ({', '.join(missing)})"
+                f"✅ Заявка #{saved.id} обновлена! Ожидайте звонка.",
+                reply_markup=REMOVE_KEYBOARD
             )
-            context.user_data.clear()
             return ConversationHandler.END
 
-        try:
-            user = update.message.from_user
-            app_id = save_application(
-                user_data=context.user_data,
-                user_id=user.id,
-                username=user.username
-            )
-            
-            if not app_id:
-                raise ValueError("Ошибка сохранения в БД")
-
-            message = [
-                f"🔔 <b>Новая заявка #{app_id}</b>\n\n",
-                f"👤 Пользователь: @{user.username or 'не указан'} (ID: {user.id})\n",
-                f"▫️ ФИО: {context.user_data['full_name']}\n",
-                f"▫️ Телефон: {context.user_data['phone']}\n",
-                f"▫️ Город: {context.user_data['city']}\n",
-                f"▫️ Возраст: {context.user_data['age']}\n",
-                f"▫️ Транспорт: {context.user_data['transport']}\n"
-            ]
-
-            if context.user_data.get('age', 0) < 18:
-                message.append("\n🚨 <b>ВНИМАНИЕ: Несовершеннолетний кандидат!</b>")
-
-            if 'special_note' in context.user_data:
-                message.append(f"\n{context.user_data['special_note']}")
-
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text="".join(message),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("✅ Принять", callback_data=f"approve_{app_id}"),
-                    InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{app_id}")
-                ]])
-            )
-
-            await update.message.reply_text(
-                "✅ Заявка принята! Ожидайте звонка.",
-                reply_markup=ReplyKeyboardRemove()
-            )
+        # Уведомление админу уже лежит в outbox; из журнала write-behind
+        # оно попадёт туда при записи в БД
+        if not saved.queued:
+            outbox.wake()
 
-        except sqlite3.Error as e:
-            logger.error(f"Ошибка БД: {str(e)}")
-            await update.message.reply_text("⚠️ Ошибка базы данных. Попробуйте позже.")
-            
-        except Exception as e:
-            logger.error(f"Критическая ошибка: {str(e)}")
-            await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте еще раз.")
-            
-        finally:
-            context.user_data.clear()
-        
-        return ConversationHandler.END
-        
-    elif choice == "✏️ Изменить":
         await update.message.reply_text(
-            "Выберите поле для изменения:",
-            reply_markup=ReplyKeyboardMarkup(
-                EDIT_FIELD_KEYBOARD,
-                resize_keyboard=True
-            )
+            "✅ Заявка принята! Ожидайте звонка.",
+            reply_markup=REMOVE_KEYBOARD
         )
-        return EDIT_FIELD
-        
-    else:
-        await update.message.reply_text("Используйте кнопки ниже👇")
-        return CONFIRMATION
 
-async def edit_field_handler(update: Update, context: CallbackContext) -> int:
-    field = update.message.text
-    valid_fields = ["ФИО", "Телефон", "Город", "Возраст", "Транспорт"]
-    
-    if field == "Назад":
-        await update.message.reply_text(
-            "🚗 Выберите транспорт:",
-            reply_markup=ReplyKeyboardMarkup(
-                TRANSPORT_KEYBOARD,
-                resize_keyboard=True
-            )
-        )
-        return TRANSPORT
-    
-    if field not in valid_fields:
-        await update.message.reply_text("Пожалуйста, выберите поле из списка")
-        return EDIT_FIELD
-    
-    context.user_data["editing_field"] = field
+    except RepositoryError as e:
+        logger.error("Ошибка БД: %s", e)
+        await update.message.reply_text("⚠️ Ошибка базы данных. Попробуйте позже.")
+        
+    except Exception as e:
+        logger.exception("Критическая ошибка: %s", e)
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте еще раз.")
+        
+    finally:
+        context.user_data.clear()
+        funnel.finish(update.effective_user.id, 'error')  # no-op, если уже submitted
     
-    if field == "Транспорт":
-        await update.message.reply_text(
-            "🚗 Выберите транспорт:",
-            reply_markup=ReplyKeyboardMarkup(
-                TRANSPORT_KEYBOARD,
-                resize_keyboard=True
-            )
-        )
-        return TRANSPORT
-    else:
-        await update.message.reply_text(f"Введите новое значение для поля '{field}':")
-        return {
-            "ФИО": FULL_NAME,
-            "Телефон": PHONE,
-            "Город": CITY,
-            "Возраст": AGE
-        }[field]
+    return ConversationHandler.END
 
+@timed(HANDLER_SECONDS, 'cancel')
 async def cancel(update: Update, context: CallbackContext) -> int:
+    funnel.finish(update.effective_user.id, 'cancel')
     await update.message.reply_text(
         "❌ Диалог прерван.",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
     context.user_data.clear()
     return ConversationHandler.END
@@ -657,38 +2975,476 @@ async def error_handler(update: Update, context: CallbackContext):
     if update.message:
         await update.message.reply_text("⚠️ Произошла внутренняя ошибка. Пожалуйста, попробуйте еще раз.")
 
+flow_engine = FlowEngine(FLOW, submit_application)
+
+# ========== EXPORT ==========
+# Выгрузка для HR: строки читаются из БД пачками и сразу кодируются в файл
+# во временном каталоге, так что в памяти никогда не лежит вся выборка.
+# Чтение и запись идут в потоке, event loop и диалоги кандидатов не ждут.
+EXPORT_COLUMNS = (
+    'id', 'created_at', 'status', 'full_name', 'phone', 'city', 'age',
+    'citizenship', 'prior_employment', 'employment_period',
+    'self_employed', 'self_employed_choice', 'transport', 'user_id', 'username', 'duplicate_of'
+)
+EXPORT_HEADERS = (
+    'ID', 'Создана', 'Статус', 'ФИО', 'Телефон', 'Город', 'Возраст',
+    'Гражданство', 'Работал ранее', 'Когда', 'Самозанятый', 'Оформление', 'Транспорт',
+    'Telegram ID', 'Username', 'Повтор заявки'
+)
+EXPORT_STATUSES = ('new', 'approved', 'rejected')
+EXPORT_USAGE = (
+    "Использование: /export [csv|xlsx] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] "
+    "[status=new|approved|rejected] [city=Город]"
+)
+EXPORT_ARG_RE = re.compile(r'(\w+)=(.*?)(?=\s+\w+=|$)')
+
+ExportFilters = namedtuple('ExportFilters', 'since until status city')
+
+def parse_export_date(value):
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"❌ Неверная дата: {value}\n{EXPORT_USAGE}")
+
+def parse_export_args(args):
+    text = " ".join(args).strip()
+    export_format = 'csv'
+    first, _, rest = text.partition(' ')
+    if first.lower() in EXPORT_FORMATS:
+        export_format, text = first.lower(), rest.strip()
+
+    options = dict(EXPORT_ARG_RE.findall(text))
+    if (text and not options) or set(options) - {'from', 'to', 'status', 'city'}:
+        raise ValueError(EXPORT_USAGE)
+
+    since = parse_export_date(options['from']) if 'from' in options else None
+    # to — включительно, до конца указанного дня
+    until = parse_export_date(options['to']) + timedelta(days=1) if 'to' in options else None
+    status = options.get('status')
+    if status is not None and status not in EXPORT_STATUSES:
+        raise ValueError(f"❌ Неизвестный статус: {status}\n{EXPORT_USAGE}")
+    city = options.get('city')
+    if city is not None:
+        city = CITY_INDEX.lookup(city) or city.strip()
+    return export_format, ExportFilters(since, until, status, city)
+
+class CsvExport:
+    """CSV частями не больше part_size: каждая часть влезает в лимит Bot API."""
+    extension = 'csv'
+
+    def __init__(self, directory, part_size=EXPORT_PART_SIZE):
+        self.directory = directory
+        self.part_size = part_size
+        self.parts = []
+        self.file = None
+        self.writer = None
+
+    def _next_part(self):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, f"applications_{len(self.parts) + 1}.csv")
+        # utf-8-sig — чтобы Excel сам узнал кодировку
+        self.file = open(path, 'w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_HEADERS)
+        self.parts.append(path)
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.file is None or self.file.tell() >= self.part_size:
+                self._next_part()
+            self.writer.writerow([
+                f"{value:%Y-%m-%d %H:%M:%S}" if isinstance(value, datetime) else value
+                for value in row
+            ])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.parts
+
+class XlsxExport:
+    """Минимальная книга XLSX: лист пишется в zip потоком, строка за строкой."""
+    extension = 'xlsx'
+    INVALID_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    STATIC_PARTS = {
+        '[Content_Types].xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ),
+        '_rels/.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ),
+        'xl/workbook.xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Заявки" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ),
+        'xl/_rels/workbook.xml.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ),
+    }
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "applications.xlsx")
+        self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        for name, content in self.STATIC_PARTS.items():
+            self.zip.writestr(name, content)
+        self.sheet = self.zip.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True)
+        self._write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        )
+        self.write_rows([EXPORT_HEADERS])
+
+    def _write(self, text):
+        self.sheet.write(text.encode('utf-8'))
+
+    def _cell(self, value):
+        if value is None:
+            return '<c/>'
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return f'<c t="n"><v>{value}</v></c>'
+        if isinstance(value, datetime):
+            value = f"{value:%Y-%m-%d %H:%M:%S}"
+        text = xml_escape(self.INVALID_XML_RE.sub('', str(value)))
+        return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+    def write_rows(self, rows):
+        self._write(''.join(
+            '<row>' + ''.join(self._cell(value) for value in row) + '</row>'
+            for row in rows
+        ))
+
+    def close(self):
+        if self.sheet is not None:
+            self._write('</sheetData></worksheet>')
+            self.sheet.close()
+            self.sheet = None
+            self.zip.close()
+        return [self.path]
+
+EXPORT_FORMATS = {
+    'csv': CsvExport,
+    'xlsx': XlsxExport,
+}
+
 # ========== ADMIN COMMANDS ==========
+@timed(HANDLER_SECONDS, 'stats')
 async def admin_stats(update: Update, context: CallbackContext):
     if update.effective_user.id != ADMIN_CHAT_ID:
         return
     
-    conn = sqlite3.connect(DB_NAME)
+    if stats_cache.reconciled_at is None:
+        try:
+            await reconcile_stats()
+        except RepositoryError as e:
+            logger.error("Ошибка статистики: %s", e)
+            await update.message.reply_text("❌ Ошибка получения статистики")
+            return
+
+    by_status = stats_cache.by_status
+    message = [
+        "📊 <b>Статистика заявок</b>\n",
+        f"• Новые: {by_status.get('new', 0)}",
+        f"• Одобренные: {by_status.get('approved', 0)}",
+        f"• Отклонённые: {by_status.get('rejected', 0)}\n",
+        "🏙️ <b>Города:</b>"
+    ]
+    for city_name, count in stats_cache.by_city.most_common(5):
+        message.append(f"• {city_name}: {count}")
+
+    message.append("\n🚗 <b>Транспорт:</b>")
+    for transport_name, count in stats_cache.by_transport.most_common():
+        message.append(f"• {transport_name}: {count}")
+
+    message.append("\n📈 <b>Заявок по дням:</b>")
+    for day, count in stats_cache.daily_throughput():
+        message.append(f"• {day:%d.%m}: {count}")
+
+    message.append("\n⏳ <b>Последние заявки:</b>\n")
+    for app in stats_cache.recent_new:
+        message.append(f"#{app[0]} - {app[2]} ({app[1]:%Y-%m-%d %H:%M})")
+
+    await update.message.reply_text("\n".join(message), parse_mode="HTML")
+
+@timed(HANDLER_SECONDS, 'export')
+async def admin_export(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT status, COUNT(*) FROM applications GROUP BY status")
-        stats = dict(cursor.fetchall())
-        
-        cursor.execute("SELECT id, created_at, city FROM applications WHERE status = 'new' ORDER BY created_at DESC LIMIT 5")
-        last_apps = cursor.fetchall()
-        
-        message = [
-            "📊 <b>Статистика заявок</b>\n",
-            f"• Новые: {stats.get('new', 0)}",
-            f"• Обработанные: {stats.get('processed', 0)}\n",
-            "⏳ <b>Последние заявки:</b>\n"
-        ]
-        
-        for app in last_apps:
-            message.append(f"#{app[0]} - {app[2]} ({app[1][:16]})\n")
-            
-        await update.message.reply_text("\n".join(message), parse_mode="HTML")
-        
-    except sqlite3.Error as e:
-        logger.error(f"DB Error: {e}")
-        await update.message.reply_text("❌ Ошибка получения статистики")
+        export_format, filters = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+    directory = tempfile.mkdtemp(prefix="export-")
+    sink = None
+    try:
+        sink = await asyncio.to_thread(EXPORT_FORMATS[export_format], directory)
+        count = await repository.export(filters, sink)
+        parts = await asyncio.to_thread(sink.close)
+        if not count:
+            await update.message.reply_text("📭 Заявок по этим фильтрам нет")
+            return
+
+        stamp = f"{datetime.now():%Y%m%d_%H%M}"
+        for number, path in enumerate(parts, 1):
+            suffix = f"_{number}" if len(parts) > 1 else ""
+            with open(path, 'rb') as document:
+                await context.bot.send_document(
+                    chat_id=update.effective_chat.id,
+                    document=document,
+                    filename=f"applications_{stamp}{suffix}.{sink.extension}",
+                    caption=f"📦 Заявок: {count}" if number == 1 else None,
+                    write_timeout=EXPORT_UPLOAD_TIMEOUT
+                )
+
+    except RepositoryError as e:
+        logger.error("Ошибка выгрузки: %s", e)
+        await update.message.reply_text("❌ Ошибка выгрузки из базы")
+
     finally:
-        conn.close()
+        if sink is not None:
+            await asyncio.to_thread(sink.close)
+        shutil.rmtree(directory, ignore_errors=True)
+
+QUEUE_CALLBACK_PATTERN = r'^(queue|approvepage|rejectcity|rejectcityok)_'
+
+def notify_decision(user_id, full_name, new_status):
+    message_text = "🎉 Ваша заявка одобрена!" if new_status == 'approved' else "😞 Заявка отклонена."
+    notifier.send(user_id, f"🔔 Уведомление для {full_name}:\n{message_text}")
+
+def render_queue_page(page, after_id, city_ref, note=None):
+    # city_ref — любая заявка из отфильтрованного города: по ней кнопки
+    # передают фильтр, не упираясь в лимит callback_data в 64 байта
+    header = "📥 <b>Очередь новых заявок</b>"
+    if page.city:
+        header += f" · {xml_escape(page.city)}"
+    lines = [note, ""] if note else []
+    lines.append(f"{header}\nВсего: {page.total}\n")
+    for app_id, created_at, full_name, city, age, transport in page.rows:
+        lines.append(
+            f"#{app_id} · {full_name} · {city} · {age} · {transport} · {as_datetime(created_at):%d.%m %H:%M}"
+        )
+    if not page.rows:
+        lines.append("Новых заявок нет 🎉")
+
+    keyboard = [moderation_buttons(row[0], short=True) for row in page.rows]
+    if page.rows:
+        # Какие заявки принять, берётся из кнопок этого же сообщения:
+        # список id в callback_data не поместился бы
+        keyboard.append([InlineKeyboardButton(
+            f"✅ Принять все на странице ({len(page.rows)})",
+            callback_data=f"approvepage_{city_ref}"
+        )])
+        if page.city:
+            keyboard.append([InlineKeyboardButton(
+                f"❌ Отклонить все: {page.city}",
+                callback_data=f"rejectcity_{city_ref}"
+            )])
+    navigation = []
+    if after_id:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=f"queue_0_{city_ref}"))
+    if page.has_more:
+        navigation.append(InlineKeyboardButton("➡️ Дальше", callback_data=f"queue_{page.rows[-1][0]}_{city_ref}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@timed(HANDLER_SECONDS, 'queue')
+async def admin_queue(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
 
+    city = None
+    if context.args:
+        text = " ".join(context.args)
+        city = text.split('=', 1)[1] if text.startswith('city=') else text
+        city = CITY_INDEX.lookup(city) or city.strip()
+
+    try:
+        page = await repository.queue_page(city=city)
+    except RepositoryError as e:
+        logger.error("Ошибка очереди: %s", e)
+        await update.message.reply_text("❌ Ошибка получения очереди")
+        return
+
+    city_ref = page.rows[0][0] if city and page.rows else 0
+    text, markup = render_queue_page(page, 0, city_ref)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+
+def shown_application_ids(markup):
+    # id заявок со своими кнопками решения в сообщении очереди
+    return [
+        int(button.callback_data.split('_', 1)[1])
+        for row in markup.inline_keyboard for button in row
+        if re.fullmatch(r'approve_\d+', button.callback_data or '')
+    ]
+
+async def apply_bulk_decision(action, changed_by, city_ref=0, app_ids=()):
+    new_status, updated = await repository.bulk_update_status(action, changed_by, city_ref, app_ids)
+    # Уведомления кандидатам уходят через общую очередь с лимитами Telegram
+    for app_id, user_id, full_name in updated:
+        stats_cache.record_status(app_id, 'new', new_status)
+        notify_decision(user_id, full_name, new_status)
+    return len(updated)
+
+@timed(HANDLER_SECONDS, 'queue')
+async def queue_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_CHAT_ID:
+        await query.message.reply_text("❌ Доступ запрещен")
+        return
+
+    action, *values = query.data.split('_')
+    try:
+        values = [int(value) for value in values]
+    except ValueError:
+        logger.error("Invalid callback data: %s", query.data)
+        return
+
+    note = None
+    try:
+        if action == 'queue':
+            after_id, city_ref = values
+        elif action == 'approvepage':
+            city_ref, = values
+            app_ids = shown_application_ids(query.message.reply_markup)
+            count = await apply_bulk_decision('approve', query.from_user.id, city_ref, app_ids) if app_ids else 0
+            note = f"✅ Принято заявок: {count}"
+            after_id = 0
+        elif action == 'rejectcity':
+            city_ref, = values
+            page = await repository.queue_page(city_ref=city_ref, limit=0)
+            await query.edit_message_text(
+                text=f"Отклонить все новые заявки из города {page.city} ({page.total})?",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("❌ Да, отклонить", callback_data=f"rejectcityok_{city_ref}"),
+                    InlineKeyboardButton("↩️ Отмена", callback_data=f"queue_0_{city_ref}")
+                ]])
+            )
+            return
+        else:
+            city_ref, = values
+            count = await apply_bulk_decision('reject', query.from_user.id, city_ref)
+            note = f"❌ Отклонено заявок: {count}"
+            after_id = 0
+
+        page = await repository.queue_page(after_id=after_id, city_ref=city_ref)
+        text, markup = render_queue_page(page, after_id, city_ref, note)
+        await query.edit_message_text(text=text, parse_mode="HTML", reply_markup=markup)
+
+    except Exception as e:
+        logger.exception("Queue callback error: %s", e)
+        await query.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+FIND_USAGE = "Использование: /find <ФИО, телефон или город>"
+FIND_STATUS_ICONS = {'new': '🆕', 'approved': '✅', 'rejected': '❌'}
+
+def parse_search_query(text):
+    text = " ".join(text.split())
+    digits = NON_DIGITS_RE.sub('', text)
+    # Запрос из одних цифр и символов номера ищется по цифрам телефона
+    if digits and not re.sub(r'[\d\s()+-]', '', text):
+        if len(digits) == 11 and digits.startswith('8'):
+            digits = '7' + digits[1:]
+        return SearchQuery(text, digits)
+    return SearchQuery(text, None)
+
+def render_search_page(query, page, rows, has_more):
+    lines = [f"🔎 <b>Поиск:</b> {xml_escape(query.text)}\n"]
+    for app_id, created_at, full_name, phone, city, status in rows:
+        lines.append(
+            f"{FIND_STATUS_ICONS.get(status, status)} #{app_id} · {full_name} · {phone} · {city}"
+            f" · {as_datetime(created_at):%d.%m %H:%M}"
+        )
+    if not rows:
+        lines.append("Ничего не найдено")
+
+    # Кнопки решения — только для заявок, которые ещё ждут модерации
+    keyboard = [moderation_buttons(row[0], short=True) for row in rows if row[5] == 'new']
+    navigation = []
+    if page:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"find_{page - 1}"))
+    if has_more:
+        navigation.append(InlineKeyboardButton("➡️ Дальше", callback_data=f"find_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@timed(HANDLER_SECONDS, 'find')
+async def admin_find(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+
+    query = parse_search_query(" ".join(context.args))
+    if len(query.phone_digits or query.text) < 3:
+        # Триграммный индекс не помогает запросам короче трёх символов
+        await update.message.reply_text(FIND_USAGE)
+        return
+
+    try:
+        rows, has_more = await repository.search(query)
+    except RepositoryError as e:
+        logger.error("Ошибка поиска: %s", e)
+        await update.message.reply_text("❌ Ошибка поиска")
+        return
+
+    # user_data сохраняется в JSON, поэтому запрос — словарем, а не namedtuple
+    context.user_data['find_query'] = query._asdict()
+    text, markup = render_search_page(query, 0, rows, has_more)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+
+@timed(HANDLER_SECONDS, 'find')
+async def find_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_CHAT_ID:
+        await query.message.reply_text("❌ Доступ запрещен")
+        return
+
+    stored = context.user_data.get('find_query')
+    if not isinstance(stored, dict):
+        await query.edit_message_text(text=f"Поиск устарел. {FIND_USAGE}")
+        return
+    search = SearchQuery(**stored)
+
+    try:
+        page = int(query.data.split('_')[1])
+        rows, has_more = await repository.search(search, page)
+        text, markup = render_search_page(search, page, rows, has_more)
+        await query.edit_message_text(text=text, parse_mode="HTML", reply_markup=markup)
+    except Exception as e:
+        logger.exception("Find callback error: %s", e)
+        await query.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+@timed(HANDLER_SECONDS, 'moderation')
 async def button_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
@@ -701,96 +3457,422 @@ async def button_callback(update: Update, context: CallbackContext):
         action, app_id = query.data.split('_')
         app_id = int(app_id)
     except:
-        logger.error("Invalid callback data")
+        logger.error("Invalid callback data: %s", query.data)
         return
+    bind_log_context(app_id=app_id, action=action)
 
-    conn = sqlite3.connect(DB_NAME)
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT status, user_id, full_name FROM applications WHERE id = ?", (app_id,))
-        result = cursor.fetchone()
+        result = await repository.update_status(app_id, action, query.from_user.id)
         
         if not result:
-            await query.edit_message_text(text=f"⚠️ Заявка #{app_id} не найдена")
+            await mark_processed(query, app_id, f"⚠️ Заявка #{app_id} не найдена")
             return
             
-        status, user_id, full_name = result
+        updated, new_status, user_id, full_name = result
         
-        if status != 'new':
-            await query.edit_message_text(text=f"⚠️ Заявка #{app_id} уже обработана")
+        if not updated:
+            await mark_processed(query, app_id, f"⚠️ Заявка #{app_id} уже обработана")
             return
 
-        new_status = 'approved' if action == 'approve' else 'rejected'
-        cursor.execute("UPDATE applications SET status = ? WHERE id = ?", (new_status, app_id))
-        conn.commit()
+        stats_cache.record_status(app_id, 'new', new_status)
+        notify_decision(user_id, full_name, new_status)
 
-        try:
-            message_text = "🎉 Ваша заявка одобрена!" if action == 'approve' else "😞 Заявка отклонена."
-            await context.bot.send_message(user_id, f"🔔 Уведомление для {full_name}:\n{message_text}")
-        except telegram_error.BadRequest:
-            logger.warning(f"User {user_id} blocked the bot")
+        await mark_processed(query, app_id, f"Заявка #{app_id}: {new_status}")
 
-        await query.edit_message_text(
-            text=query.message.text.replace("Статус: new", f"Статус: {new_status}"),
-            parse_mode="HTML",
-            reply_markup=None
+    except Exception as e:
+        logger.exception("Callback error: %s", e)
+        await query.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+async def mark_processed(query, app_id, note):
+    # В дайджесте, /queue и /find на одном сообщении кнопки нескольких
+    # заявок и навигация: убираем только строку обработанной заявки
+    processed = {f"approve_{app_id}", f"reject_{app_id}"}
+    rows = [
+        row for row in (query.message.reply_markup.inline_keyboard if query.message.reply_markup else [])
+        if not any(button.callback_data in processed for button in row)
+    ]
+    await query.edit_message_text(
+        text=f"{query.message.text_html}\n\n{note}",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(rows) if rows else None
+    )
+
+# ========== WEB SERVER ==========
+# Один ASGI-сервер на PORT: приём апдейтов в режиме webhook, health и readiness.
+# В режиме polling он отвечает только на проверки платформы.
+def create_web_app(on_update, is_ready, metrics_sources=lambda: [({}, collect_metrics())]):
+    # Starlette импортируется здесь, как и uvicorn: сервер поднимается
+    # уже после того, как бот начал отвечать, и импорт не входит в старт
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import PlainTextResponse, Response
+    from starlette.routing import Route
+
+    async def health(request: Request):
+        return PlainTextResponse(f"🚀 Бот активен! Порт: {PORT}")
+
+    async def ready(request: Request):
+        if request.app.state.ready and is_ready():
+            return PlainTextResponse("ok")
+        return PlainTextResponse("starting", status_code=503)
+
+    async def metrics(request: Request):
+        return PlainTextResponse(
+            render_metrics(metrics_sources()),
+            media_type='text/plain; version=0.0.4'
         )
 
-    except Exception as e:
-        logger.error(f"Callback error: {e}")
-        await query.edit_message_text(text=f"❌ Ошибка: {str(e)}")
-    finally:
-        conn.close()
+    async def telegram_webhook(request: Request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return Response(status_code=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        if not isinstance(data, dict):
+            return Response(status_code=400)
+        await on_update(data)
+        return Response()
+
+    routes = [
+        Route('/', health, methods=['GET', 'HEAD']),
+        Route('/ready', ready, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ]
+    if BOT_MODE == 'webhook':
+        routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=['POST']))
+
+    web_app = Starlette(routes=routes)
+    web_app.state.ready = False
+    return web_app
 
 # ========== MAIN ==========
-def main():
-    init_db()
-    
-    flask_thread = Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
+background_tasks = []
+
+async def warm_up():
+    # Прогрев после старта: бот уже принимает апдейты, а статистика и
+    # фильтр дублей догружаются в фоне (запросы сами дождутся схемы)
+    try:
+        await reconcile_stats()
+        await reload_contact_filter()
+    except RepositoryError as e:
+        logger.error("Ошибка загрузки статистики: %s", e)
+    startup.mark('warm_up')
+
+async def conversation_expiry_loop(application):
+    expiry = ConversationExpiry()
+    handlers = [
+        handler for group in application.handlers.values() for handler in group
+        if isinstance(handler, ConversationHandler)
+    ]
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        for handler in handlers:
+            # Публичного доступа к диалогам у ConversationHandler нет
+            for key in expiry.sweep(handler._conversations):
+                user_id = key[-1]
+                funnel.finish(user_id, 'timeout')
+                application.drop_user_data(user_id)
+
+async def on_startup(application, worker=None):
+    notifier.start(application.bot)
+    if WRITE_BEHIND:
+        path = WRITE_BEHIND_PATH if worker is None else f"{WRITE_BEHIND_PATH}.{worker}"
+        await intake.start(path, on_intake_flushed)
+    # Уведомления админу рассылает один процесс: так соблюдается лимит на чат
+    if worker is None or worker == ADMIN_WORKER:
+        outbox.start(deliver_announcement)
+    background_tasks.append(asyncio.create_task(warm_up()))
+    background_tasks.append(asyncio.create_task(stats_reconcile_loop()))
+    background_tasks.append(asyncio.create_task(loop_lag_monitor()))
+    background_tasks.append(asyncio.create_task(conversation_expiry_loop(application)))
 
-    application = ApplicationBuilder() \
+async def on_shutdown(application):
+    for task in background_tasks:
+        task.cancel()
+    await intake.stop()
+    notifier.flush_digest()  # иначе текущая пачка outbox ждала бы окна дайджеста
+    await outbox.stop()
+    await notifier.stop()
+    # Хранилища закрываются позже, в close_stores(): последний сброс
+    # состояния диалогов идёт в application.shutdown(), уже после нас
+
+def build_application(owns=None) -> Application:
+    builder = ApplicationBuilder() \
         .token(BOT_TOKEN) \
-        .concurrent_updates(True) \
-        .build()
+        .request(TimedRequest(HTTPXRequest(connection_pool_size=256))) \
+        .update_queue(asyncio.Queue(maxsize=GUARD_QUEUE_SIZE)) \
+        .concurrent_updates(GUARD_MAX_IN_FLIGHT)
+    if BOT_MODE == 'webhook':
+        # Апдейты приходят через наш сервер, Updater не нужен
+        builder = builder.updater(None)
+    if state_store is not None:
+        builder = builder.persistence(ConversationPersistence(state_store, owns=owns))
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
-        states={
-            CITIZENSHIP: [MessageHandler(filters.TEXT & ~filters.COMMAND, citizenship)],
-            CITIZENSHIP_SNG: [MessageHandler(filters.TEXT & ~filters.COMMAND, citizenship_sng)],
-            CITIZENSHIP_OTHER: [MessageHandler(filters.TEXT & ~filters.COMMAND, citizenship_other)],
-            FULL_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, full_name)],
-            PRIOR_EMPLOYMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, prior_employment)],
-            EMPLOYMENT_PERIOD: [MessageHandler(filters.TEXT & ~filters.COMMAND, employment_period)],
-            PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, phone)],
-            CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, city)],
-            AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, age)],
-            SELF_EMPLOYED: [MessageHandler(filters.TEXT & ~filters.COMMAND, self_employed)],
-            SELF_EMPLOYED_CHOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, self_employed_choice)],
-            TRANSPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, transport)],
-            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation)],
-            EDIT_FIELD: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_field_handler)],
-        },
+        states=flow_engine.conversation_states(),
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="application_form",
+        persistent=state_store is not None,
     )
 
+    application.add_handler(TypeHandler(Update, guard_update), group=-1)
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("export", admin_export))
+    application.add_handler(CommandHandler("queue", admin_queue))
+    application.add_handler(CommandHandler("find", admin_find))
+    application.add_handler(CallbackQueryHandler(queue_callback, pattern=QUEUE_CALLBACK_PATTERN))
+    application.add_handler(CallbackQueryHandler(find_callback, pattern=r'^find_\d+$'))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_error_handler(error_handler)
 
-    def shutdown(signum, frame):
-        print("\n🛑 Завершение работы...")
-        application.stop()
-        exit(0)
+    return application
+
+def create_web_server(web_app):
+    # uvicorn сам перехватывает SIGINT/SIGTERM: serve() возвращается,
+    # после чего бот корректно останавливается. Импорт здесь: в режиме
+    # polling сервер поднимается уже после того, как бот начал отвечать
+    import uvicorn
+    return uvicorn.Server(uvicorn.Config(
+        web_app,
+        host='0.0.0.0',
+        port=PORT,
+        log_level='warning',
+        log_config=None  # логи uvicorn идут в общую очередь, а не в свой обработчик
+    ))
+
+async def serve(server, on_listening=None):
+    # Webhook регистрируется, только когда сервер уже принимает соединения:
+    # иначе первые доставки Telegram упрутся в закрытый порт
+    serving = asyncio.create_task(server.serve())
+    try:
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        if server.started and on_listening is not None:
+            await on_listening()
+    except BaseException:
+        server.should_exit = True
+        await asyncio.wait([serving])
+        raise
+    await serving
+
+async def set_webhook(bot):
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=False
+    )
+
+async def run_bot():
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужен WEBHOOK_URL")
+
+    if WORKERS > 1:
+        if BOT_MODE != 'webhook':
+            raise RuntimeError("Несколько воркеров поддерживаются только в режиме webhook")
+        await init_db()
+        await close_stores()
+        await run_dispatcher()
+        return
+
+    # Миграции идут в фоне, параллельно с getMe и запуском бота: запросы
+    # к БД (в том числе загрузка состояния диалогов в initialize) ждут
+    # только схему, а не весь старт
+    schema = asyncio.create_task(init_db())
+    schema.add_done_callback(lambda _: startup.mark('schema'))
+    repository.migration = schema
+    if state_store is not None:
+        state_store.migration = schema
+
+    application = build_application()
+    startup.mark('build')
+
+    async def on_update(data):
+        await application.update_queue.put(Update.de_json(data=data, bot=application.bot))
+
+    try:
+        async with application:
+            startup.mark('initialize')
+            await on_startup(application)
+            await application.start()
+
+            if BOT_MODE != 'webhook':
+                await application.bot.delete_webhook()
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            startup.mark('started')
+
+            # Starlette и uvicorn импортируются в потоке, пока event loop уже отвечает
+            web_app = await asyncio.to_thread(create_web_app, on_update, lambda: application.running)
+            server = await asyncio.to_thread(create_web_server, web_app)
+            web_app.state.ready = True
+            logger.info("✅ Бот запущен (%s)", BOT_MODE)
+            logger.info("Запуск: %s", startup.summary())
+            try:
+                await serve(server, (lambda: set_webhook(application.bot)) if BOT_MODE == 'webhook' else None)
+            finally:
+                logger.info("🛑 Завершение работы...")
+                web_app.state.ready = False
+                if application.updater and application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+                await on_shutdown(application)
+    finally:
+        # Хранилища закрываются после выхода из application: при выходе PTB
+        # ещё раз сбрасывает состояние диалогов в persistence
+        await close_stores()
+
+# ========== WORKERS ==========
+# Режим WORKERS > 1: этот процесс только принимает webhook и раскладывает
+# апдейты по воркерам по user_id, так что диалог пользователя всегда
+# обрабатывается одним и тем же процессом. Всё админское (callback-кнопки,
+# команды от ADMIN_CHAT_ID) идёт в ADMIN_WORKER.
+def update_user_id(data):
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from'].get('id')
+    return None
+
+def worker_for_update(data, workers=WORKERS):
+    user_id = update_user_id(data)
+    if user_id is None or user_id == ADMIN_CHAT_ID or 'callback_query' in data:
+        return ADMIN_WORKER
+    return user_id % workers
+
+def worker_owns(index, workers=WORKERS):
+    def owns(user_id):
+        if user_id == ADMIN_CHAT_ID:
+            return index == ADMIN_WORKER
+        return user_id % workers == index
+    return owns
+
+async def push_metrics(index, metrics):
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        metrics.put((index, collect_metrics()))
+
+async def run_worker(index, updates, metrics):
+    application = build_application(owns=worker_owns(index))
+    try:
+        async with application:
+            await on_startup(application, worker=index)
+            background_tasks.append(asyncio.create_task(push_metrics(index, metrics)))
+            await application.start()
+            logger.info("Воркер %s запущен", index)
+
+            while True:
+                data = await asyncio.to_thread(updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data=data, bot=application.bot))
+
+            await application.stop()
+            await on_shutdown(application)
+    finally:
+        await close_stores()
+
+def worker_main(index, updates, metrics):
+    # Останавливаемся только по команде диспетчера, а не по Ctrl+C в терминале
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, updates, metrics))
+
+class WorkerPool:
+    def __init__(self, size):
+        import multiprocessing
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(size)]
+        self.processes = [None] * size
+        self.metrics = self.context.Queue()
+        self.worker_metrics = {}  # индекс воркера -> последний снимок
+
+    def spawn(self, index):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.queues[index], self.metrics),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self.spawn(index)
+
+    def alive(self):
+        return all(process is not None and process.is_alive() for process in self.processes)
+
+    async def supervise(self):
+        # Упавший воркер перезапускается; его очередь сохраняется в диспетчере
+        while True:
+            await asyncio.sleep(5)
+            self.receive_metrics()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Воркер %s завершился с кодом %s, перезапуск", index, process.exitcode)
+                    self.spawn(index)
+
+    def receive_metrics(self):
+        while True:
+            try:
+                index, snapshot = self.metrics.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_metrics[index] = snapshot
+
+    def metrics_sources(self):
+        sources = [({'worker': 'dispatcher'}, collect_metrics())]
+        sources.extend(
+            ({'worker': str(index)}, snapshot)
+            for index, snapshot in sorted(self.worker_metrics.items())
+        )
+        return sources
+
+    def route(self, data):
+        self.queues[worker_for_update(data, len(self.queues))].put(data)
+
+    async def stop(self):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join, 30)
 
-    signal.signal(signal.SIGINT, shutdown)
-    signal.signal(signal.SIGTERM, shutdown)
+async def run_dispatcher():
+    pool = WorkerPool(WORKERS)
+    pool.start()
 
-    print("✅ Бот запущен")
-    application.run_polling()
+    async def on_update(data):
+        pool.route(data)
+
+    web_app = create_web_app(on_update, pool.alive, pool.metrics_sources)
+    server = create_web_server(web_app)
+    supervisor = asyncio.create_task(pool.supervise())
+    lag_monitor = asyncio.create_task(loop_lag_monitor())
+
+    async def register_webhook():
+        async with Bot(BOT_TOKEN) as bot:
+            await set_webhook(bot)
+
+    web_app.state.ready = True
+    logger.info("✅ Бот запущен (webhook, воркеров: %s)", WORKERS)
+    try:
+        await serve(server, register_webhook)
+    finally:
+        logger.info("🛑 Завершение работы...")
+        web_app.state.ready = False
+        supervisor.cancel()
+        lag_monitor.cancel()
+        await pool.stop()
+
+startup.mark('module')
+
+def main():
+    asyncio.run(run_bot())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()